@@ -0,0 +1,58 @@
+'''
+    Measures the cold start cost of importing gaclient.
+
+    Each sample imports gaclient in a fresh interpreter, the interpreter
+    start up itself is measured separately and subtracted. Usage::
+
+        $ python benchmarks/import_time.py -n 20
+
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Modules that should not be imported by ``import gaclient``.
+HEAVY_MODULES = ['requests', 'requests_oauthlib', 'oauthlib', 'ssl', 'numpy']
+
+
+def sample (statement, count):
+    timings = []
+
+    for _ in range(count):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement], cwd=ROOT)
+        timings.append(time.time() - start)
+
+    return sorted(timings)[len(timings) // 2]
+
+
+def loaded_modules ():
+    output = subprocess.check_output([sys.executable, '-c',
+        'import sys, gaclient; print(" ".join(sorted(sys.modules)))'],
+        cwd=ROOT)
+
+    return [m for m in HEAVY_MODULES if m in output.decode().split()]
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=10,
+        help='Number of samples, the median is reported.')
+    args = parser.parse_args()
+
+    baseline = sample('pass', args.count)
+    imported = sample('import gaclient', args.count)
+
+    print('interpreter start up: {:.1f} ms'.format(1000 * baseline))
+    print('import gaclient:      {:.1f} ms'.format(1000 * (imported - baseline)))
+    print('heavy modules loaded: {}'.format(', '.join(loaded_modules()) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
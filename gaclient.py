@@ -37,28 +37,48 @@ __author__ = 'Tiemo Kieft'
 __version__ = '0.3b2'
 __license__ = 'Apache 2.0'
 
+import array
+import collections
+import contextlib
+import csv
 import datetime
 import functools
+import heapq
 import itertools
+import json
 import logging
+import mmap
+import os
+import re
+import struct
 import sys
 import random
+import tempfile
+import threading
 import time
 
-from requests.exceptions import ConnectionError, Timeout
-from ssl import SSLError
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+    wait)
 
 PY3 = (sys.version_info.major == 3)
 
 if PY3:
-    from urllib.parse import urlencode
+    from collections.abc import Mapping
+    from urllib.parse import urlencode, urlparse
 
     basestring = str
     unicode = str
+    long = int
 else:
+    from collections import Mapping
     from urllib import urlencode
+    from urlparse import urlparse
 
-from requests_oauthlib import OAuth2Session
+# requests, requests_oauthlib and numpy are slow to import, they are
+# imported on first use so that short-lived processes that only build
+# queries start quickly.
+_NETWORK_ERRORS = None
+_NUMPY = None
 
 
 # Google OAuth2 token refresh url.
@@ -67,6 +87,9 @@ REFRESH_URL = 'https://accounts.google.com/o/oauth2/token'
 #: Baseurls for each type of request
 BASEURLS = {
     'data': 'https://www.googleapis.com/analytics/v3/data/ga',
+    'metadata': 'https://www.googleapis.com/analytics/v3/metadata/ga/columns',
+    'management': 'https://www.googleapis.com/analytics/v3/management',
+    'batch': 'https://www.googleapis.com/batch/analytics/v3',
 }
 
 #: Google Analytics OAuth2 scopes.
@@ -81,12 +104,93 @@ DATATYPES = {
     'INTEGER': int,
     'CURRENCY': float,
     'FLOAT': float,
+    'PERCENT': float,
+    'TIME': float,
 }
 
+#: Headers sent with every request. Google only serves compressed
+#: responses to clients that also mention ``gzip`` in their user agent.
+REQUEST_HEADERS = {
+    'Accept-Encoding': 'gzip',
+    'User-Agent': 'gaclient/{} (gzip)'.format(__version__),
+}
+
+#: Response fields requested for the first page of a data query. Later
+#: pages omit ``columnHeaders``, the headers of the first page are reused.
+PAGE_FIELDS = ['kind', 'totalResults', 'columnHeaders', 'nextLink',
+    'containsSampledData', 'rows']
+
+#: Reasons of Analytics errors after which a request is retried.
+RETRY_REASONS = ('internalError', 'backendError', 'rateLimitExceeded',
+    'userRateLimitExceeded', 'quotaExceeded')
+
+#: Maximum number of metrics that can be selected in a single query.
+MAX_METRICS = 10
+
+#: Maximum number of dimensions that can be selected in a single query.
+MAX_DIMENSIONS = 7
+
 LOG = logging.getLogger('gaclient')
 LOG.addHandler(logging.NullHandler())
 
 
+def _select_json_decoder ():
+    ''' Returns the ``loads`` function of the fastest JSON library that
+        is installed, orjson and ujson are preferred over :mod:`json`.
+    '''
+    for name in ('orjson', 'ujson'):
+        try:
+            return __import__(name).loads
+        except ImportError:
+            pass
+
+    return _json_loads
+
+
+def _json_loads (body):
+    ''' Decode `body` with :mod:`json`, which only accepts :class:`bytes`
+        from Python 3.6 on. Invalid UTF-8 raises a :class:`ValueError`.
+    '''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    return json.loads(body)
+
+
+#: Function that is used to decode JSON response bodies. It is called
+#: with the raw, already decompressed, response body as :class:`bytes`
+#: and should raise a :class:`ValueError` on invalid input.
+JSON_DECODER = _select_json_decoder()
+
+
+def _network_errors ():
+    ''' Returns the exceptions raised by failed requests that are retried. '''
+    global _NETWORK_ERRORS
+
+    if _NETWORK_ERRORS is None:
+        from requests.exceptions import ConnectionError, Timeout
+        from ssl import SSLError
+
+        _NETWORK_ERRORS = (ConnectionError, Timeout, SSLError, ValueError)
+
+    return _NETWORK_ERRORS
+
+
+def _numpy ():
+    ''' Returns the numpy module, or ``False`` if it is not installed. '''
+    global _NUMPY
+
+    if _NUMPY is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+
+        _NUMPY = numpy
+
+    return _NUMPY
+
+
 class Error (Exception):
     ''' General error class. '''
 
@@ -99,6 +203,9 @@ class InvalidResponse (Error):
 class UnsupportedDataType (Error):
     ''' Raised when Analytics data of an unsupported type. '''
 
+class InvalidQuery (Error):
+    ''' Raised when a query is rejected by a :class:`MetadataCatalog`. '''
+
 class AnalyticsError (Error):
     ''' Raised when Google Analytics returns an error response. '''
 
@@ -110,6 +217,394 @@ class AnalyticsError (Error):
 
         self.message = u"code={}, errors={}, msg={}".format(code,errors,message)
 
+    def __reduce__ (self):
+        return (AnalyticsError, (self.code, self.args[0], self.errors))
+
+
+class _RowSchema (object):
+    ''' Column names and parsers shared by all rows of a result set. '''
+
+    __slots__ = ('names', 'parsers', 'index')
+
+    def __init__ (self, columns):
+        self.names = tuple(name for name, _ in columns)
+        self.parsers = tuple(parser for _, parser in columns)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+
+class LazyRow (Mapping):
+    ''' A read-only row that converts its values on first access.
+
+    Lazy rows are returned by a :class:`Cursor` created with
+    ``lazy_rows=True``. They wrap the raw values of a row, and convert
+    and remember each value the first time it is accessed. Apart from
+    being immutable they behave like the dictionaries that are
+    returned otherwise.
+    '''
+
+    __slots__ = ('_raw', '_schema', '_values')
+
+    def __init__ (self, raw, schema):
+        self._raw = raw
+        self._schema = schema
+        self._values = None
+
+
+    def __getitem__ (self, key):
+        i = self._schema.index[key]
+
+        if self._values is None:
+            self._values = [_MISSING] * len(self._raw)
+
+        value = self._values[i]
+        if value is _MISSING:
+            value = self._values[i] = self._schema.parsers[i](self._raw[i])
+
+        return value
+
+
+    def __iter__ (self):
+        return iter(self._schema.names)
+
+
+    def __len__ (self):
+        return len(self._schema.names)
+
+
+    def __repr__ (self):
+        return 'LazyRow({!r})'.format(dict(self))
+
+
+_MISSING = object()
+
+
+class InternTable (object):
+    ''' A bounded table of shared string instances for a single column.
+
+    Calling the table with a string returns an equal, shared, instance of
+    that string, so that repeating dimension values are only kept in
+    memory once.
+
+    :param maxsize: Maximum number of distinct values that is kept. When
+                    the table is full the least recently used value is
+                    evicted, so columns with a very high cardinality do
+                    not grow the table indefinitely.
+    '''
+
+    def __init__ (self, maxsize=65536):
+        assert maxsize > 0
+
+        self.maxsize = maxsize
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __call__ (self, value):
+        values = self._values
+        shared = values.get(value)
+
+        if shared is not None:
+            # Recency only matters once values are being evicted.
+            if len(values) >= self.maxsize:
+                try:
+                    values[value] = values.pop(value)
+                except KeyError:
+                    pass
+
+            return shared
+
+        value = unicode(value)
+        with self._lock:
+            if len(values) >= self.maxsize:
+                values.popitem(last=False)
+
+            return values.setdefault(value, value)
+
+
+    def __len__ (self):
+        return len(self._values)
+
+
+class InternPool (object):
+    ''' A set of :class:`InternTable` instances, one for each column.
+
+    Pass an instance as `intern` argument to several :class:`Cursor`
+    instances to share the interned values between them.
+
+    :param maxsize: The `maxsize` of each table.
+    '''
+
+    def __init__ (self, maxsize=65536):
+        self.maxsize = maxsize
+        self._tables = {}
+        self._lock = threading.Lock()
+
+
+    def table (self, column):
+        ''' Returns the :class:`InternTable` for `column`. '''
+        table = self._tables.get(column)
+
+        if table is None:
+            with self._lock:
+                table = self._tables.setdefault(column,
+                    InternTable(self.maxsize))
+
+        return table
+
+
+_INT64 = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+
+
+def _encode_row (values):
+    ''' Encode a sequence of values, each value is prefixed with a one
+        byte type tag.
+    '''
+    out = bytearray()
+
+    for value in values:
+        if value is None:
+            out += b'N'
+
+        elif value is True or value is False:
+            out += b'T' if value else b'F'
+
+        elif isinstance(value, (int, long)) and -2 ** 63 <= value < 2 ** 63:
+            out += b'i'
+            out += _INT64.pack(value)
+
+        elif isinstance(value, float):
+            out += b'f'
+            out += _FLOAT.pack(value)
+
+        elif isinstance(value, (int, long)):
+            # Integers beyond 64 bits are stored as decimal strings.
+            data = str(value).encode('ascii')
+            out += b'I'
+            out += _LENGTH.pack(len(data))
+            out += data
+
+        elif isinstance(value, basestring):
+            data = unicode(value).encode('utf-8')
+            out += b's'
+            out += _LENGTH.pack(len(data))
+            out += data
+
+        elif type(value) is datetime.date:
+            out += b'd'
+            out += _INT64.pack(value.toordinal())
+
+        else:
+            raise UnsupportedDataType('Cannot buffer {!r}'.format(value))
+
+    return bytes(out)
+
+
+def _decode_row (data, offset, count):
+    ''' Decode `count` values that were encoded by :func:`_encode_row`
+        from `data`, starting at `offset`. Returns the values and the
+        offset of the following row.
+    '''
+    values = []
+
+    for _ in range(count):
+        tag = data[offset:offset + 1]
+        offset += 1
+
+        if tag == b'i':
+            values.append(_INT64.unpack_from(data, offset)[0])
+            offset += 8
+
+        elif tag == b'f':
+            values.append(_FLOAT.unpack_from(data, offset)[0])
+            offset += 8
+
+        elif tag == b's' or tag == b'I':
+            size = _LENGTH.unpack_from(data, offset)[0]
+            value = data[offset + 4:offset + 4 + size].decode('utf-8')
+            values.append(value if tag == b's' else int(value))
+            offset += 4 + size
+
+        elif tag == b'd':
+            values.append(datetime.date.fromordinal(
+                _INT64.unpack_from(data, offset)[0]))
+            offset += 8
+
+        else:
+            values.append({b'N': None, b'T': True, b'F': False}[tag])
+
+    return values, offset
+
+
+class RowBuffer (object):
+    ''' Holds a complete result set with bounded memory usage.
+
+    Rows are kept in memory until there are more than `max_rows`, after
+    that all rows are written to a temporary file in a compact binary
+    format and read back through a memory map. Rows can be iterated
+    over repeatedly and accessed by index::
+
+        >>> with gaclient.RowBuffer(gaclient.ResponseIterator(cursor)) as rows:
+        ...     rows[-1]
+        ...     sorted(rows, key=lambda row: row['visits'])
+
+    :param rows: Optional iterable of rows to add to the buffer.
+    :param names: The column names, defaults to the keys of the first row.
+    :param max_rows: Number of rows that are kept in memory.
+    :param directory: Directory of the temporary files, see
+                      :func:`tempfile.TemporaryFile`.
+
+    Values must be ``None``, :class:`bool`, :class:`int`, :class:`float`,
+    strings or :class:`datetime.date`. Rows are returned as new
+    dictionaries, so changing them does not change the buffer. The
+    temporary files are removed by :meth:`close`.
+    '''
+
+    def __init__ (self, rows=None, names=None, max_rows=100000,
+            directory=None):
+        assert max_rows >= 0
+
+        self.names = tuple(names) if names is not None else None
+        self.max_rows = max_rows
+        self.directory = directory
+
+        self._rows = []
+        self._len = 0
+        self._data = None
+        self._index = None
+        self._size = 0
+        self._maps = None
+
+        if rows is not None:
+            self.extend(rows)
+
+
+    @property
+    def spilled (self):
+        ''' ``True`` if the rows have been written to disk. '''
+        return self._data is not None
+
+
+    def append (self, row):
+        ''' Add a row to the end of the buffer. '''
+        if self.names is None:
+            self.names = tuple(row)
+
+        values = tuple(row[name] for name in self.names)
+
+        if self._data is not None:
+            self._write(values)
+        else:
+            self._rows.append(values)
+            if len(self._rows) > self.max_rows:
+                self._spill()
+
+        self._len += 1
+
+
+    def extend (self, rows):
+        ''' Add all rows of an iterable to the end of the buffer. '''
+        for row in rows:
+            self.append(row)
+
+
+    def _spill (self):
+        LOG.info('Spilling {} rows to disk.'.format(len(self._rows)))
+
+        self._data = tempfile.TemporaryFile(dir=self.directory)
+        self._index = tempfile.TemporaryFile(dir=self.directory)
+
+        for values in self._rows:
+            self._write(values)
+
+        self._rows = []
+
+
+    def _write (self, values):
+        data = _encode_row(values)
+
+        self._index.write(_OFFSET.pack(self._size))
+        self._data.write(data)
+        self._size += len(data)
+
+        # Maps that are still referenced remain valid for the rows they
+        # cover, a new map is created on the next read.
+        self._maps = None
+
+
+    def _mapped (self):
+        if self._maps is None:
+            self._data.flush()
+            self._index.flush()
+            self._maps = (
+                mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ),
+                mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ))
+
+        return self._maps
+
+
+    def __getitem__ (self, index):
+        if index < 0:
+            index += self._len
+
+        if not 0 <= index < self._len:
+            raise IndexError('RowBuffer index out of range')
+
+        if self._data is None:
+            return dict(zip(self.names, self._rows[index]))
+
+        data, offsets = self._mapped()
+        offset = _OFFSET.unpack_from(offsets, _OFFSET.size * index)[0]
+
+        return dict(zip(self.names, _decode_row(data, offset, len(self.names))[0]))
+
+
+    def __iter__ (self):
+        if self._data is None:
+            for values in list(self._rows):
+                yield dict(zip(self.names, values))
+            return
+
+        data, _ = self._mapped()
+        offset = 0
+
+        # Rows are stored back to back, so sequential reads do not need
+        # the index.
+        for _ in range(self._len):
+            values, offset = _decode_row(data, offset, len(self.names))
+            yield dict(zip(self.names, values))
+
+
+    def __len__ (self):
+        return self._len
+
+
+    def close (self):
+        ''' Release the rows and remove the temporary files. '''
+        if self._maps is not None:
+            for m in self._maps:
+                m.close()
+            self._maps = None
+
+        for fp in (self._data, self._index):
+            if fp is not None:
+                fp.close()
+
+        self._data = self._index = None
+        self._rows = []
+        self._len = 0
+        self._size = 0
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
 
 class Cursor (object):
     ''' Wraps a single request against the Google Analytics data API.
@@ -122,34 +617,76 @@ class Cursor (object):
     Optional keyword arguments:
         `attempts`: Each cursor will make at most `attempts` attempts to
                     execute its requet. Defaults to 5.
+        `parse_pool`: An executor, usually a
+                      :class:`concurrent.futures.ProcessPoolExecutor`, that
+                      decodes and converts the response data with
+                      :func:`parse_page`. This moves CPU bound parsing out
+                      of the current process when many cursors are
+                      downloaded concurrently.
+        `lazy_rows`: If ``True`` rows are returned as :class:`LazyRow`
+                     instances, which only convert the values that are
+                     accessed. Defaults to ``False``.
+        `intern`: If ``True`` values of ``STRING`` columns are interned in
+                  an :class:`InternPool` that is shared with all following
+                  pages. Pass an :class:`InternPool` to share it with other
+                  cursors as well. Defaults to ``None``.
+        `hedge`: An optional :class:`HedgePolicy` that duplicates slow
+                 requests.
+        `page_sizer`: An optional :class:`PageSizer` that chooses the
+                      `max_results` of this and all following pages.
     '''
 
     def __init__ (self, session, *args, **kwargs):
         self.session = session
 
         self.args = args
-        self.kwargs = kwargs
+        self.kwargs = dict(kwargs)
 
         self.attempts = kwargs.pop('attempts', 10)
+        self.parse_pool = kwargs.pop('parse_pool', None)
+        self.lazy_rows = kwargs.pop('lazy_rows', False)
+        self.intern = kwargs.pop('intern', None)
+        self.hedge = kwargs.pop('hedge', None)
+        self.page_sizer = kwargs.pop('page_sizer', None)
+
+        if self.intern is True:
+            self.intern = self.kwargs['intern'] = InternPool()
 
         assert self.attempts is None or self.attempts > 0
 
         if self.attempts is None:
             self.attempts = 1
 
+        # max_results is the eighth argument of build_data_query.
+        if self.page_sizer is not None and len(args) < 8:
+            kwargs.setdefault('max_results', self.page_sizer.size)
+
         self.params = build_data_query(*args, **kwargs)
 
         self._next_link = u'{}?{}'.format(
             BASEURLS['data'], urlencode(self.params))
 
-        self._row_buffer = []
+        self._raw_rows = []
+        self._row_buffer = None
         self._len = None
+        self._headers = None
         self._columns = []
+        self._schema = None
+
+        # True if the rows in _raw_rows have already been converted.
+        self._converted = False
 
         #: True if the resultset contains sampled data. Sampling can
         #: be prevented in most cases by sharding requests by date.
         self.sampled = None
 
+        #: Totals of the metrics over all results, only available if
+        #: ``totalsForAllResults`` is among the requested `fields`.
+        self.totals = None
+
+        if kwargs.get('catalog') is not None:
+            self._prepare_columns(kwargs['catalog'])
+
 
     @property
     def next_cursor (self):
@@ -161,7 +698,17 @@ class Cursor (object):
             kwargs = dict(self.kwargs,
                 start_index=self.params['start-index'] + self.params['max-results'])
 
+            if self.page_sizer is not None:
+                kwargs['max_results'] = self.page_sizer.size
+
+            if 'fields' in self.params:
+                kwargs['fields'] = [f for f in self.params['fields'].split(',')
+                    if f != 'columnHeaders']
+
             next_cursor = Cursor(self.session, *self.args, **kwargs)
+            next_cursor._headers = self._headers
+            next_cursor._columns = self._columns
+            next_cursor._schema = self._schema
 
             return next_cursor
 
@@ -174,16 +721,20 @@ class Cursor (object):
             for attempt in range(self.attempts):
 
                 try:
-                    self._row_buffer = self._download_next_link()
+                    self._download_next_link()
 
-                except (ConnectionError, Timeout, SSLError, ValueError, AnalyticsError) as e:
+                except _network_errors() + (AnalyticsError,) as e:
 
-                    if type(e) == 'AnalyticsError' and e.reason != 'internalError':
+                    if not _is_retryable(e):
                         raise
 
-                    if attempt == self.attempts:
+                    if attempt == self.attempts - 1:
                         raise
 
+                    if self.page_sizer is not None and _is_overloaded(e):
+                        self.page_sizer.observe(error=True)
+                        self._resize(self.page_sizer.size)
+
                     delay = (2 ** (attempt+random.random()))
 
                     LOG.info('An error occured, retry {} of {} in {} seconds'.format(
@@ -196,97 +747,1795 @@ class Cursor (object):
 
 
 
-    def _download_next_link (self):
-        LOG.info('Downloading data.')
-        response = execute_request(self.session, self._next_link)
+    def _download_next_link (self):
+        LOG.info('Downloading data.')
+
+        start = time.time()
+        body = _get_content(self.session, self._next_link, self.hedge)
+        elapsed = time.time() - start
+
+        if self.parse_pool is not None:
+            self._load_page_in_pool(body)
+        else:
+            self._load_response(_decode_response(body, self._next_link))
+
+        if self.page_sizer is not None:
+            self.page_sizer.observe(len(self._raw_rows), elapsed, len(body))
+
+
+    def _resize (self, max_results):
+        ''' Change the number of rows requested for this page only, the
+            following pages keep the `max_results` of the cursor.
+        '''
+        if max_results < self.params['max-results']:
+            self.params['max-results'] = max_results
+            self._next_link = u'{}?{}'.format(
+                BASEURLS['data'], urlencode(self.params))
+
+
+    def _load_response (self, response):
+        ''' Store the results of a decoded data response. '''
+        if not response['kind'] == 'analytics#gaData':
+            raise InvalidResponse('Expected data response.')
+
+        self._set_columns_from_response(response)
+        self._next_link = response.get('nextLink')
+
+        self.sampled = self.sampled or response['containsSampledData']
+
+        if response['totalResults'] == 0:
+            self._raw_rows = []
+        else:
+            self._raw_rows = response['rows']
+
+        self._len = response['totalResults']
+
+
+    def _load_page_in_pool (self, body):
+        page = self.parse_pool.submit(parse_page, body,
+            headers=self._headers, convert=not self.lazy_rows).result()
+
+        self._set_columns_from_response(page)
+        self._next_link = page.get('nextLink')
+        self._converted = not self.lazy_rows
+
+        self.sampled = self.sampled or page['containsSampledData']
+
+        rows = page['rows']
+        if self._converted and self.intern is not None:
+            tables = [(i, parser) for i, (_, parser) in enumerate(self._columns)
+                if isinstance(parser, InternTable)]
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i, table in tables:
+                    row[i] = table(row[i])
+
+        self._raw_rows = rows
+        self._len = page['totalResults']
+
+
+    def _parse_row (self, row):
+        if self._converted:
+            return dict(zip(self._schema.names, row))
+
+        if self.lazy_rows:
+            return LazyRow(row, self._schema)
+
+        return {k: t(row[i]) for i, (k, t) in enumerate(self._columns)}
+
+
+    def _set_columns_from_response (self, response):
+        headers = response.get('columnHeaders')
+
+        if headers is not None:
+            self._headers = headers
+            self._columns = [self._parse_header(h) for h in headers]
+            self._schema = _RowSchema(self._columns)
+
+        elif self._headers is None:
+            raise InvalidResponse('Response contains no column headers.')
+
+        totals = response.get('totalsForAllResults')
+        if totals is not None:
+            parsers = dict(self._columns)
+            self.totals = dict((remove_ga_prefix(k), parsers[remove_ga_prefix(k)](v))
+                for k, v in totals.items())
+
+
+    def _prepare_columns (self, catalog):
+        ''' Build the row parsers from `catalog`, so that the first page
+            does not need to contain column headers.
+        '''
+        self._set_columns_from_response({
+            'columnHeaders': catalog.headers(self.params)})
+
+        if 'fields' in self.params:
+            self.params['fields'] = u','.join(f for f in
+                self.params['fields'].split(',') if f != 'columnHeaders')
+
+        self._next_link = u'{}?{}'.format(
+            BASEURLS['data'], urlencode(self.params))
+
+
+    def _parse_header (self, header):
+        name, parser = _column_parser(header)
+
+        if self.intern is not None and header['dataType'] == 'STRING' \
+                and parser is DATATYPES['STRING']:
+            parser = self.intern.table(name)
+
+        return (name, parser)
+
+
+    def columns (self):
+        ''' Returns the rows of this page in columnar form.
+
+        :returns: An ordered dictionary that maps each column name to a
+                  list of parsed values. Columns are converted straight
+                  from the response data when the rows of this cursor
+                  have not been iterated over yet.
+        '''
+        self.execute()
+
+        if self._row_buffer is None and self._converted:
+            return collections.OrderedDict(
+                (name, [row[i] for row in self._raw_rows])
+                for i, (name, _) in enumerate(self._columns))
+
+        if self._row_buffer is None:
+            return collections.OrderedDict(
+                (name, [parser(row[i]) for row in self._raw_rows])
+                for i, (name, parser) in enumerate(self._columns))
+
+        return collections.OrderedDict(
+            (name, [row[name] for row in self._row_buffer])
+            for name, _ in self._columns)
+
+
+    def __iter__ (self):
+        self.execute()
+
+        if self._row_buffer is None:
+            self._row_buffer = [self._parse_row(row) for row in self._raw_rows]
+            self._raw_rows = None
+
+        for row in self._row_buffer:
+            yield row
+
+    def __len__ (self):
+        self.execute()
+        return self._len
+
+
+class ResponseIterator (object):
+    ''' Automatically iterates over all pages of a Cursor.
+
+    :param cursor: A :class:`Cursor` instance.
+    :param limit: Optional limit on the number of results that are
+                  yielded. The limit is pushed down into the
+                  `max_results` of each page, so no more rows are
+                  downloaded than are yielded.
+    :param prefetch: If ``True`` the next page is downloaded in the
+                     background while the rows of the current page are
+                     consumed.
+
+    Call :meth:`close`, or use the iterator as a context manager, to stop
+    iterating early. This cancels a prefetched page and releases the
+    buffered rows::
+
+        >>> with gaclient.ResponseIterator(cursor, prefetch=True) as it:
+        ...     for row in it:
+        ...         if done(row):
+        ...             break
+    '''
+
+    def __init__ (self, cursor, limit=None, prefetch=False):
+        self.cursor = cursor
+        self.limit = limit
+        self.prefetch = prefetch
+        self._index = 0
+        self._closed = False
+        self._origin = cursor
+        self._pool = None
+        self._next = None
+
+        LOG.info('Initialize ResponseIterator with limit={}'.format(
+            self.limit))
+
+
+    def __iter__ (self):
+        cursor = self.cursor
+        if cursor is not None:
+            self._push_down(cursor)
+
+        while cursor is not None and not self._closed:
+            if self._next is not None:
+                self._next[1].result()
+                self._next = None
+
+            cursor.execute()
+            following = cursor.next_cursor
+            rows = cursor._raw_rows if cursor._row_buffer is None \
+                else cursor._row_buffer
+
+            if following is not None and self._push_down(following, len(rows)) \
+                    and self.prefetch:
+                self._next = (following, self._executor().submit(following.execute))
+
+            for row in cursor:
+                if self._closed or (self.limit and self._index >= self.limit):
+                    LOG.info('ResponseIterator limit reached.')
+                    return
+
+                self._index += 1
+                yield row
+
+            if self.limit and self._index >= self.limit:
+                return
+
+            cursor = self.cursor = following
+
+        self._shutdown()
+
+
+    def close (self):
+        ''' Stop iterating. A page that is being prefetched is cancelled,
+            or abandoned if its request is already in flight, and the
+            rows of the current page are released.
+        '''
+        self._closed = True
+
+        if self._next is not None:
+            following, future = self._next
+            future.cancel()
+            self._release(following)
+            self._next = None
+
+        if self.cursor is not None and self.cursor is not self._origin:
+            self._release(self.cursor)
+
+        self._shutdown()
+        self.cursor = None
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+
+    def _push_down (self, cursor, pending=0):
+        ''' Shrink the page of `cursor` to the number of rows that remain
+            before the limit is reached, taking into account `pending`
+            rows of the current page. Returns ``False`` if no rows remain.
+        '''
+        if not self.limit:
+            return True
+
+        remaining = self.limit - self._index - pending
+
+        if remaining <= 0:
+            return False
+
+        if cursor._len is None:
+            cursor._resize(remaining)
+
+        return True
+
+
+    def _executor (self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(1)
+
+        return self._pool
+
+
+    def _shutdown (self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+    def _release (self, cursor):
+        cursor._raw_rows = []
+        cursor._row_buffer = []
+
+
+    def pages (self):
+        ''' Yields the :class:`Cursor` of each page of results. The
+            `limit` is not applied to pages.
+        '''
+        while self.cursor:
+            yield self.cursor
+
+            self.cursor = self.cursor.next_cursor
+
+
+_QuerySpec = collections.namedtuple('_QuerySpec', ['profile_id',
+    'start_date', 'end_date', 'metrics', 'dimensions', 'filters', 'sort'])
+
+
+def _query_spec (params):
+    ''' Build a :class:`_QuerySpec` from the result of
+        :func:`build_data_query`. Paging parameters are dropped.
+    '''
+    dimensions = params.get('dimensions')
+
+    return _QuerySpec(
+        profile_id=params['ids'],
+        start_date=parse_date(params['start-date']),
+        end_date=parse_date(params['end-date']),
+        metrics=tuple(params['metrics'].split(',')),
+        dimensions=tuple(dimensions.split(',')) if dimensions else (),
+        filters=params.get('filters'),
+        sort=params.get('sort'))
+
+
+def _query_group (spec):
+    ''' Returns the part of `spec` that must be identical for two
+        queries to be answerable from the same result.
+    '''
+    return (spec.profile_id, spec.dimensions, spec.filters, spec.sort)
+
+
+def _query_covers (spec, other):
+    ''' Returns ``True`` if the result of `spec` contains the result
+        of `other`.
+    '''
+    if _query_group(spec) != _query_group(other):
+        return False
+
+    if not set(other.metrics) <= set(spec.metrics):
+        return False
+
+    if 'ga:date' in spec.dimensions:
+        return (spec.start_date <= other.start_date
+            and other.end_date <= spec.end_date)
+
+    return (spec.start_date == other.start_date
+        and spec.end_date == other.end_date)
+
+
+def plan_covering_queries (specs, merge_dates=True):
+    ''' Rewrite a batch of queries into a small set of covering queries.
+
+    Queries with the same profile, dimensions, filters and sort order are
+    combined by taking the union of their metrics, as long as the union
+    does not exceed :data:`MAX_METRICS`. When ``ga:date`` is one of the
+    dimensions overlapping and adjacent date ranges are merged as well,
+    otherwise only queries over the same date range are combined.
+
+    :param specs: An iterable of query specifications as used by
+                  :class:`QueryCache`.
+    :param merge_dates: If ``False`` date ranges are never merged. Wider
+                        date ranges are more likely to be sampled.
+
+    :returns: A list of query specifications, every query in `specs`
+              is covered by at least one of them.
+    '''
+    groups = collections.OrderedDict()
+    for spec in specs:
+        key = _query_group(spec)
+        if not merge_dates or 'ga:date' not in spec.dimensions:
+            key += (spec.start_date, spec.end_date)
+        groups.setdefault(key, []).append(spec)
+
+    one_day = datetime.timedelta(days=1)
+    rv = []
+
+    for members in groups.values():
+        members.sort(key=lambda s: (s.start_date, s.end_date))
+        current = None
+
+        for spec in members:
+            if current is not None:
+                metrics = current.metrics + tuple(
+                    m for m in spec.metrics if m not in current.metrics)
+
+                if (spec.start_date <= current.end_date + one_day
+                        and len(metrics) <= MAX_METRICS):
+                    current = current._replace(metrics=metrics,
+                        end_date=max(current.end_date, spec.end_date))
+                    continue
+
+                rv.append(current)
+
+            current = spec
+
+        rv.append(current)
+
+    # Drop queries that ended up being covered by another one, which
+    # happens when a query was split off because of the metrics limit.
+    covering = []
+    for spec in rv:
+        if not any(_query_covers(o, spec) for o in covering):
+            covering = [o for o in covering if not _query_covers(spec, o)]
+            covering.append(spec)
+
+    return covering
+
+
+class ResultRows (list):
+    ''' A list of rows that also records whether the data is sampled. '''
+
+    def __init__ (self, rows=(), sampled=False):
+        list.__init__(self, rows)
+
+        #: True if any page of the query that produced the rows
+        #: contained sampled data.
+        self.sampled = bool(sampled)
+
+
+class QueryCache (object):
+    r''' Answers data queries from the complete results of earlier queries
+        over the same profile, dimensions, filters and sort order.
+
+    A query is answered without contacting Google Analytics if a cached or
+    in flight query selects at least the requested metrics, and its date
+    range contains the requested date range. Date ranges can only be sliced
+    when ``ga:date`` is one of the dimensions.
+
+    Results are returned as :class:`ResultRows`. A sampled result is only
+    used to answer the exact query that produced it. Other queries are
+    sent on their own, and are not merged into wider date ranges.
+
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param max_workers: Number of queries :meth:`fetch_many` executes
+                        concurrently.
+    :param \*\*kwargs: Passed to every :class:`Cursor` that is created.
+
+    Results are kept for the lifetime of the cache, call :meth:`clear`
+    to release them.
+    '''
+
+    def __init__ (self, session, max_workers=4, **kwargs):
+        self.session = session
+        self.max_workers = max_workers
+        self.cursor_kwargs = kwargs
+
+        self._entries = []
+        self._lock = threading.Lock()
+
+
+    def fetch (self, *args, **kwargs):
+        ''' Returns all rows for a query. Arguments are the same as for
+            :func:`build_data_query`, paging arguments are ignored.
+
+        :returns: A :class:`ResultRows` instance.
+        '''
+        return self._fetch_spec(_query_spec(build_data_query(*args, **kwargs)))
+
+
+    def _fetch_spec (self, spec):
+        with self._lock:
+            entry, owned = self._reserve(spec)
+
+        if owned:
+            self._run(*entry)
+
+        return self._answer(spec, *entry)
+
+
+    def fetch_many (self, queries):
+        ''' Returns all rows for each query in `queries`.
+
+        :param queries: A list of dictionaries of keyword arguments for
+                        :func:`build_data_query`.
+
+        :returns: A list with a :class:`ResultRows` for each query.
+
+        Queries that cannot be answered from the cache are rewritten with
+        :func:`plan_covering_queries` and executed concurrently.
+        '''
+        specs = [_query_spec(build_data_query(**q)) for q in queries]
+
+        with self._lock:
+            missing = [s for s in specs if self._find(s) is None]
+            sampled = set(_query_group(entry[0]) for entry in self._entries
+                if self._is_sampled(entry))
+
+            planned = plan_covering_queries(
+                [s for s in missing if _query_group(s) not in sampled])
+            planned += plan_covering_queries(
+                [s for s in missing if _query_group(s) in sampled],
+                merge_dates=False)
+
+            owned = [self._reserve(s)[0] for s in planned]
+
+        if owned:
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                list(pool.map(lambda entry: self._run(*entry), owned))
+
+        rv = []
+        for spec in specs:
+            with self._lock:
+                entry = self._find(spec)
+
+            if entry is None:
+                rv.append(self._fetch_spec(spec))
+            else:
+                rv.append(self._answer(spec, *entry))
+
+        return rv
+
+
+    def clear (self):
+        ''' Forget all cached results. '''
+        with self._lock:
+            self._entries = []
+
+
+    def _find (self, spec):
+        for entry in self._entries:
+            if _query_covers(entry[0], spec) and (entry[0] == spec
+                    or not self._is_sampled(entry)):
+                return entry
+
+
+    def _is_sampled (self, entry):
+        ''' Returns ``True`` if the query of `entry` has completed and
+            its result is sampled.
+        '''
+        future = entry[1]
+
+        return future.done() and future.exception() is None \
+            and future.result().sampled
+
+
+    def _reserve (self, spec):
+        entry = self._find(spec)
+        if entry is not None:
+            LOG.debug('Query answered from cache.')
+            return entry, False
+
+        entry = (spec, Future())
+        self._entries.append(entry)
+        return entry, True
+
+
+    def _query_kwargs (self, spec):
+        return {
+            'dimensions': list(spec.dimensions) or None,
+            'filters': [spec.filters] if spec.filters else None,
+            'sort': [spec.sort] if spec.sort else None,
+        }
+
+
+    def _run (self, spec, future):
+        kwargs = dict(self.cursor_kwargs, **self._query_kwargs(spec))
+
+        try:
+            cursor = Cursor(self.session, spec.profile_id, spec.start_date,
+                spec.end_date, list(spec.metrics), **kwargs)
+
+            rows = ResultRows()
+            for page in ResponseIterator(cursor).pages():
+                rows.extend(page)
+                rows.sampled = rows.sampled or bool(page.sampled)
+
+            future.set_result(rows)
+
+        except Exception as ex:
+            with self._lock:
+                self._entries.remove((spec, future))
+            future.set_exception(ex)
+
+
+    def _answer (self, spec, cached_spec, future):
+        rows = future.result()
+
+        if rows.sampled and cached_spec != spec:
+            LOG.info('Covering query is sampled, sending the query itself.')
+            return self._fetch_spec(spec)
+
+        if cached_spec.metrics != spec.metrics:
+            keys = [remove_ga_prefix(c) for c in spec.dimensions + spec.metrics]
+            metrics = [remove_ga_prefix(m) for m in spec.metrics]
+
+            # Google Analytics omits rows in which all selected metrics
+            # are zero.
+            rows = [{k: row[k] for k in keys} for row in rows
+                if any(row[m] for m in metrics)]
+
+        if (cached_spec.start_date, cached_spec.end_date) != (
+                spec.start_date, spec.end_date):
+            rows = [row for row in rows
+                if spec.start_date <= row['date'] <= spec.end_date]
+
+        return ResultRows(rows, future.result().sampled)
+
+
+def split_metrics (metrics, size=MAX_METRICS):
+    ''' Split `metrics` into groups of at most `size` metrics. '''
+    return [metrics[i:i + size] for i in range(0, len(metrics), size)]
+
+
+class _WideRows (object):
+    ''' Iterates over the rows of :func:`fetch_wide`. '''
+
+    def __init__ (self, groups):
+        #: Whether each metric group contains sampled data, ``None`` until
+        #: the group is downloaded.
+        self.sampled_groups = [None] * groups
+        self._rows = None
+
+
+    @property
+    def sampled (self):
+        ''' ``True`` if any metric group contains sampled data. '''
+        return any(self.sampled_groups)
+
+
+    def __iter__ (self):
+        return self
+
+
+    def __next__ (self):
+        return next(self._rows)
+
+    next = __next__
+
+
+    def close (self):
+        self._rows.close()
+
+
+def fetch_wide (session, profile_id, start_date, end_date, metrics,
+        dimensions=None, filters=None, ordered=False, fill=None,
+        max_workers=None, **kwargs):
+    r''' Download a query with more metrics than a single request allows.
+
+    The metrics are split into groups of at most :data:`MAX_METRICS`
+    metrics over the same dimensions. The groups are downloaded
+    concurrently and joined on their dimension values with a hash join.
+
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param profile_id: The Google Analytics profile id to query.
+    :param start_date: Start date of the request.
+    :param end_date: End date of the request.
+    :param metrics: A list of metrics to download, of any length.
+    :param dimensions: Optional list of at most :data:`MAX_DIMENSIONS`
+                       dimensions.
+    :param filters: Optional list of filter predicates.
+    :param ordered: If ``True`` rows are yielded sorted by their dimension
+                    values, otherwise rows are streamed as soon as the
+                    first group is being downloaded and all other groups
+                    are complete.
+    :param fill: Value of metrics for which a group did not return a row.
+    :param max_workers: Maximum number of groups that are downloaded
+                        concurrently, defaults to one per group.
+    :param \*\*kwargs: Passed to every :class:`Cursor`. A `sort` is not
+                       accepted, the join does not keep the order of the
+                       groups and a sort on a metric is rejected by the
+                       groups that do not select it. Use `ordered` instead.
+
+    :returns: An iterator that yields one row per distinct combination
+              of dimension values. Its ``sampled`` attribute is ``True``
+              if any metric group contains sampled data, and
+              ``sampled_groups`` holds the flag of each group. The groups
+              can be sampled differently, a warning is logged when they
+              are.
+    '''
+    assert isinstance(metrics, list) and len(metrics) > 0
+    assert dimensions is None or len(dimensions) <= MAX_DIMENSIONS
+    assert kwargs.get('sort') is None, 'fetch_wide does not support sort'
+
+    keys = [remove_ga_prefix(d) for d in add_ga_prefix(dimensions) or []]
+    groups = split_metrics(metrics)
+    names = [[remove_ga_prefix(m) for m in add_ga_prefix(g)] for g in groups]
+    result = _WideRows(len(groups))
+
+    def iterate (index):
+        cursor = Cursor(session, profile_id, start_date, end_date,
+            groups[index], dimensions=dimensions, filters=filters, **kwargs)
+
+        for page in ResponseIterator(cursor).pages():
+            page.execute()
+            result.sampled_groups[index] = \
+                bool(result.sampled_groups[index] or page.sampled)
+
+            for row in page:
+                yield row
+
+    def build (index):
+        return dict((tuple(row[k] for k in keys), row) for row in iterate(index))
+
+    def join (pool):
+        futures = [pool.submit(build, i) for i in range(1, len(groups))]
+
+        # The first group is probed in the calling thread, so that its
+        # first page is downloaded concurrently with the other groups.
+        probe = iterate(0)
+        first = next(probe, None)
+        tables = [f.result() for f in futures]
+
+        for row in itertools.chain([first] if first else [], probe):
+            key = tuple(row[k] for k in keys)
+            row = dict(row)
+            for group_names, table in zip(names[1:], tables):
+                other = table.pop(key, None)
+                row.update(other or dict.fromkeys(group_names, fill))
+
+            yield row
+
+        leftovers = collections.OrderedDict()
+        for table in tables:
+            for key, other in table.items():
+                if key not in leftovers:
+                    leftovers[key] = dict.fromkeys(
+                        itertools.chain.from_iterable(names), fill)
+                leftovers[key].update(other)
+
+        for row in leftovers.values():
+            yield row
+
+    LOG.info('Downloading {} metrics in {} groups.'.format(
+        len(metrics), len(groups)))
+
+    def generate ():
+        pool = ThreadPoolExecutor(max_workers or len(groups))
+        try:
+            rows = join(pool)
+            if ordered:
+                rows = sorted(rows, key=lambda row: tuple(row[k] for k in keys))
+
+            for row in rows:
+                yield row
+
+        finally:
+            pool.shutdown(wait=False)
+
+        if len(set(result.sampled_groups)) > 1:
+            LOG.warning('Metric groups are sampled differently: {}.'.format(
+                result.sampled_groups))
+
+    result._rows = generate()
+    return result
+
+
+@functools.total_ordering
+class _Desc (object):
+    ''' Reverses the ordering of a value that cannot be negated. '''
+
+    __slots__ = ('value',)
+
+    def __init__ (self, value):
+        self.value = value
+
+    def __eq__ (self, other):
+        return self.value == other.value
+
+    def __lt__ (self, other):
+        return other.value < self.value
+
+
+def _sort_key (sort):
+    ''' Returns a function that maps a row to its key under the sort
+        predicates `sort`.
+    '''
+    columns = [(remove_ga_prefix(s.lstrip('-')), s.startswith('-'))
+        for s in add_ga_prefix(sort)]
+
+    def key (row):
+        values = []
+        for name, descending in columns:
+            value = row[name]
+            if descending:
+                value = -value if isinstance(value, (int, float)) \
+                    else _Desc(value)
+            values.append(value)
+
+        return tuple(values)
+
+    return key
+
+
+def merge_sorted (sources, sort=None, metrics=None):
+    ''' Merge results that are sorted on the same keys into a single
+        sorted stream.
+
+    :param sources: A list of :class:`Cursor` or :class:`ResponseIterator`
+                    instances, or other iterables of rows, each sorted by
+                    `sort`. A :class:`Cursor` is iterated over all its
+                    pages.
+    :param sort: The sort predicates the sources were queried with, as
+                 passed to :func:`build_data_query`. Defaults to the
+                 ``sort`` of the first source that is a cursor.
+    :param metrics: Optional list of metrics. Consecutive rows that are
+                    equal in all other columns are combined into a single
+                    row by summing these metrics.
+
+    Only the current row of each source is held in memory, so rows are
+    yielded as soon as the first page of every source is downloaded.
+    Rows with equal keys are yielded in the order of `sources`. Use
+    this to combine the date shards or profiles of a query that was
+    split up. To combine rows, `sort` should include all dimensions.
+
+    :returns: A generator that yields rows.
+    '''
+    iterators = []
+    for source in sources:
+        if isinstance(source, Cursor):
+            source = ResponseIterator(source)
+
+        if sort is None and isinstance(source, ResponseIterator) \
+                and source.cursor is not None:
+            sort = source.cursor.params.get('sort', '').split(',')
+
+        iterators.append(iter(source))
+
+    assert sort and all(sort), 'merge_sorted requires sort predicates'
+
+    key = _sort_key(sort)
+    heap = []
+
+    for i, it in enumerate(iterators):
+        row = next(it, None)
+        if row is not None:
+            heap.append((key(row), i, row))
+
+    heapq.heapify(heap)
+
+    if metrics:
+        metrics = [remove_ga_prefix(m) for m in add_ga_prefix(metrics)]
+
+    def identity (row):
+        return sorted((k, v) for k, v in row.items() if k not in metrics)
+
+    pending = None
+
+    while heap:
+        row_key, i, row = heap[0]
+
+        following = next(iterators[i], None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(following), i, following))
+
+        if not metrics:
+            yield row
+            continue
+
+        if pending is not None and pending[0] == row_key \
+                and pending[1] == identity(row):
+            for m in metrics:
+                pending[2][m] += row[m]
+            continue
+
+        if pending is not None:
+            yield pending[2]
+
+        pending = (row_key, identity(row), dict(row))
+
+    if pending is not None:
+        yield pending[2]
+
+
+def _vector (size, fill):
+    numpy = _numpy()
+
+    if numpy:
+        return numpy.full(size, fill, dtype=numpy.float64)
+
+    return array.array('d', [fill]) * size
+
+
+def _resize (vector, size, fill):
+    if len(vector) >= size:
+        return vector
+
+    numpy = _numpy()
+
+    if numpy:
+        return numpy.concatenate([vector, _vector(size - len(vector), fill)])
+
+    vector.extend([fill] * (size - len(vector)))
+    return vector
+
+
+def _scatter (op, vector, index, values):
+    ''' Combine `values` into `vector` at the positions in `index`. '''
+    numpy = _numpy()
+
+    if numpy:
+        index = numpy.asarray(index, dtype=numpy.intp)
+        values = numpy.asarray(values, dtype=numpy.float64)
+
+        if op == 'sum':
+            vector += numpy.bincount(index, weights=values,
+                minlength=len(vector))
+        elif op == 'min':
+            numpy.minimum.at(vector, index, values)
+        else:
+            numpy.maximum.at(vector, index, values)
+
+    elif op == 'sum':
+        for i, v in zip(index, values):
+            vector[i] += v
+
+    else:
+        op = min if op == 'min' else max
+        for i, v in zip(index, values):
+            vector[i] = op(vector[i], v)
+
+
+class Rollup (object):
+    ''' Computes grouped aggregates over pages of columnar data.
+
+    :param group_by: A list of column names to group by. An element may
+                     also be a ``(name, column, function)`` tuple, which
+                     groups by `function` applied to the values of
+                     `column`, e.g. to roll up dates into weeks.
+    :param aggregates: A dictionary that maps output names to aggregate
+                       specifications.
+
+    An aggregate specification is one of ``('sum', column)``,
+    ``('mean', column)``, ``('min', column)``, ``('max', column)``,
+    ``('ratio', numerator, denominator)`` or ``('count',)``. The
+    specification ``'sum'`` is short for ``('sum', name)``, the same
+    goes for ``'mean'``, ``'min'`` and ``'max'``::
+
+        >>> rollup = gaclient.Rollup(
+            ['source', ('week', 'date', lambda d: d.isocalendar()[1])],
+            {'visits': 'sum', 'bounce_rate': ('ratio', 'bounces', 'visits')})
+        >>> rollup.feed(cursor)
+        >>> rollup.results()
+
+    Only partial aggregates are kept, so the memory used is proportional
+    to the number of groups. Partial aggregates computed over different
+    shards, pages or profiles can be combined with :meth:`merge`.
+    Computations use NumPy when it is installed, and fall back to
+    :mod:`array` otherwise.
+    '''
+
+    OPERATIONS = ('sum', 'mean', 'min', 'max', 'ratio', 'count')
+
+    _FILL = {'sum': 0.0, 'min': float('inf'), 'max': float('-inf')}
+
+    def __init__ (self, group_by, aggregates):
+        self.group_by = [g if isinstance(g, tuple) else (g, g, None)
+            for g in group_by]
+        self.aggregates = collections.OrderedDict()
+
+        for name, spec in aggregates.items():
+            if isinstance(spec, basestring):
+                spec = (spec, name)
+
+            assert spec[0] in self.OPERATIONS
+            self.aggregates[name] = tuple(spec)
+
+        self._index = {}
+        self._keys = []
+        self._counts = _vector(0, 0.0)
+        self._state = {}
+        self._integral = {}
+
+        for spec in self.aggregates.values():
+            op = spec[0]
+            if op in ('sum', 'mean', 'ratio'):
+                for column in spec[1:]:
+                    self._state[('sum', column)] = _vector(0, 0.0)
+            elif op in ('min', 'max'):
+                self._state[(op, spec[1])] = _vector(0, self._FILL[op])
+
+
+    def feed (self, source):
+        ''' Aggregate all pages of `source`, which is either a
+            :class:`Cursor` or a :class:`ResponseIterator`.
+        '''
+        if isinstance(source, Cursor):
+            source = ResponseIterator(source)
+
+        for page in source.pages():
+            self.update(page.columns())
+
+
+    def update (self, columns):
+        ''' Aggregate a page of data.
+
+        :param columns: A dictionary that maps column names to equally
+                        long sequences of values, see :meth:`Cursor.columns`.
+        '''
+        keys = [self._group_column(columns, g) for g in self.group_by]
+        size = len(columns[next(iter(columns))]) if columns else 0
+        keys = list(zip(*keys)) if keys else [()] * size
+
+        self._combine(keys, [1.0] * len(keys), {
+            state: columns[state[1]] for state in self._state})
+
+
+    def merge (self, other):
+        ''' Merge the partial aggregates of `other` into this instance.
+            Both instances must have been created with the same aggregates.
+        '''
+        assert set(self._state) == set(other._state)
+
+        for column, integral in other._integral.items():
+            self._integral[column] = self._integral.get(column, True) and integral
+
+        self._combine(other._keys, other._counts, other._state, True)
+
+
+    def results (self):
+        ''' Returns a list with a row of aggregates for each group. '''
+        rv = []
+
+        for i, key in enumerate(self._keys):
+            row = dict(zip((g[0] for g in self.group_by), key))
+
+            for name, spec in self.aggregates.items():
+                row[name] = self._aggregate(i, spec)
+
+            rv.append(row)
+
+        return rv
+
+
+    def __len__ (self):
+        return len(self._keys)
+
+
+    def _group_column (self, columns, group):
+        name, column, function = group
+        if function is None:
+            return columns[column]
+
+        return [function(v) for v in columns[column]]
+
+
+    def _combine (self, keys, counts, state, partial=False):
+        index = []
+        for key in keys:
+            i = self._index.get(key)
+            if i is None:
+                i = self._index[key] = len(self._keys)
+                self._keys.append(key)
+            index.append(i)
+
+        size = len(self._keys)
+        self._counts = _resize(self._counts, size, 0.0)
+        _scatter('sum', self._counts, index, counts)
+
+        for (op, column), values in state.items():
+            if not partial and len(values):
+                self._integral[column] = (self._integral.get(column, True)
+                    and isinstance(values[0], int))
+
+            vector = _resize(self._state[(op, column)], size, self._FILL[op])
+            _scatter(op, vector, index, values)
+            self._state[(op, column)] = vector
+
+
+    def _aggregate (self, i, spec):
+        op = spec[0]
+
+        if op == 'count':
+            return int(self._counts[i])
+
+        if op == 'mean':
+            return float(self._state[('sum', spec[1])][i] / self._counts[i])
+
+        if op == 'ratio':
+            denominator = self._state[('sum', spec[2])][i]
+            if denominator == 0:
+                return None
+            return float(self._state[('sum', spec[1])][i] / denominator)
+
+        value = self._state[(op, spec[1])][i]
+        if self._integral.get(spec[1]):
+            return int(value)
+
+        return float(value)
+
+
+class MetadataCatalog (object):
+    ''' A local catalogue of the dimensions and metrics that are known
+        to the Google Analytics Metadata API.
+
+    :param path: Optional path of a JSON file the catalogue is loaded
+                 from and stored to. The file has the same format as a
+                 Metadata API response, so a copy of such a response can
+                 be used as a stand-in, e.g. in tests.
+    :param max_age: Number of seconds after which :meth:`refresh`
+                    contacts the Metadata API again. Defaults to one day.
+
+    A catalogue is used by :func:`build_data_query` to validate queries
+    before they are sent, and by :class:`Cursor` to build its row parsers
+    before the first page arrives::
+
+        >>> catalog = gaclient.MetadataCatalog('columns.json')
+        >>> catalog.refresh(session)
+        >>> cursor = gaclient.Cursor(session, PROFILE_ID, '2012-01-01',
+            '2012-01-31', ['visits'], ['date'], catalog=catalog)
+    '''
+
+    def __init__ (self, path=None, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+
+        self.etag = None
+        self.fetched = None
+        self._data = {}
+        self._columns = {}
+        self._templates = []
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as fp:
+                self._load(JSON_DECODER(fp.read()))
+
+
+    @property
+    def stale (self):
+        ''' ``True`` if the catalogue is older than `max_age`. '''
+        return self.fetched is None or time.time() - self.fetched > self.max_age
+
+
+    def refresh (self, session, force=False):
+        ''' Download the catalogue from the Metadata API if it is stale.
+            The request is conditional on the ETag of the current
+            catalogue, so an unchanged catalogue is not transferred again.
+
+        :param session: An authorized OAuth2 session, see :func:`build_session`.
+        :param force: Refresh even if the catalogue is not stale.
+        '''
+        if not (force or self.stale):
+            return
+
+        headers = dict(REQUEST_HEADERS)
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+
+        LOG.info('Refreshing metadata catalogue.')
+        response = session.get(BASEURLS['metadata'], headers=headers)
+
+        if response.status_code == 304:
+            LOG.debug('Metadata catalogue is unchanged.')
+            self.fetched = self._data['fetched'] = time.time()
+        else:
+            data = JSON_DECODER(response.content)
+            _raise_for_error(data)
+            data['fetched'] = time.time()
+            self._load(data)
+
+        self._save()
+
+
+    def column (self, name):
+        ''' Returns the attributes of column `name`, or ``None`` if
+            the column is unknown.
+        '''
+        name = add_ga_prefix(name)
+        attributes = self._columns.get(name)
+
+        if attributes is None:
+            for pattern, template in self._templates:
+                match = pattern.match(name)
+                if match and int(template.get('minTemplateIndex', 0)) <= \
+                        int(match.group(1)) <= int(template.get('maxTemplateIndex', 0)):
+                    return template
+
+        return attributes
+
+
+    def headers (self, params):
+        ''' Returns the column headers of the response to a query, as
+            returned by :func:`build_data_query`.
+        '''
+        names = params.get('dimensions', '').split(',') + params['metrics'].split(',')
+
+        return [{'name': name, 'dataType': self.column(name)['dataType']}
+            for name in names if name]
+
+
+    def validate (self, params):
+        ''' Validate a query, as returned by :func:`build_data_query`.
+
+        :raises: An :class:`InvalidQuery` is raised if the query selects
+                 unknown columns, dimensions as metrics or vice versa,
+                 the same column twice, sorts on columns that are not
+                 selected, or filters on unknown columns.
+        '''
+        errors = []
+        selected = []
+
+        for type_, key in (('DIMENSION', 'dimensions'), ('METRIC', 'metrics')):
+            for name in filter(None, params.get(key, '').split(',')):
+                column = self.column(name)
+
+                if column is None:
+                    errors.append('unknown column {}'.format(name))
+                elif column['type'] != type_:
+                    errors.append('{} is not a {}'.format(name, type_.lower()))
+                elif column.get('status') == 'DEPRECATED':
+                    LOG.warning('Column {} is deprecated.'.format(name))
+
+                if name in selected:
+                    errors.append('{} is selected twice'.format(name))
+                selected.append(name)
+
+        for name in filter(None, params.get('sort', '').split(',')):
+            if name.lstrip('-') not in selected:
+                errors.append('cannot sort on unselected column {}'.format(name))
+
+        for name in re.findall(r'ga:\w+', params.get('filters', '')):
+            if self.column(name) is None:
+                errors.append('cannot filter on unknown column {}'.format(name))
+
+        if errors:
+            raise InvalidQuery(', '.join(errors))
+
+
+    def __len__ (self):
+        return len(self._columns) + len(self._templates)
+
+
+    def _load (self, data):
+        self.etag = data.get('etag')
+        self.fetched = data.get('fetched')
+        self._data = data
+        self._columns = {}
+        self._templates = []
+
+        for item in data.get('items', ()):
+            attributes = item['attributes']
+
+            if 'XX' in item['id']:
+                pattern = re.compile('^{}$'.format(
+                    re.escape(item['id']).replace('XX', '(\\d+)')))
+                self._templates.append((pattern, attributes))
+            else:
+                self._columns[item['id']] = attributes
+
+
+    def _save (self):
+        if self.path is None:
+            return
+
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as fp:
+            json.dump(self._data, fp)
+
+        os.rename(tmp, self.path)
+
+
+def _execute_with_retries (session, url, attempts):
+    ''' Execute a request like :func:`execute_request`, errors that are
+        retryable are retried with exponential backoff.
+    '''
+    for attempt in range(attempts):
+        try:
+            return execute_request(session, url)
+
+        except _network_errors() + (AnalyticsError,) as e:
+            if not _is_retryable(e) or attempt == attempts - 1:
+                raise
+
+            delay = (2 ** (attempt+random.random()))
+
+            LOG.info('An error occured, retry {} of {} in {} seconds'.format(
+                attempt, attempts, delay))
+
+            time.sleep(delay)
+
+
+def list_management (session, path, max_results=1000, attempts=5):
+    ''' Iterate over all items of a Management API collection.
+
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param path: Path of the collection, relative to
+                 ``BASEURLS['management']``, e.g. ``/accounts``.
+    :param max_results: Number of items that are requested per page.
+    :param attempts: Number of attempts for each page, rate limit and
+                     server errors are retried with exponential backoff.
+
+    :returns: A generator that yields the items of the collection, it
+              follows ``nextLink`` until all pages are retrieved.
+    '''
+    url = u'{}{}?{}'.format(BASEURLS['management'], path,
+        urlencode({'max-results': max_results}))
+
+    while url:
+        response = _execute_with_retries(session, url, attempts)
+
+        for item in response.get('items', ()):
+            yield item
+
+        url = response.get('nextLink')
+
+
+class ProfileDirectory (object):
+    ''' A cached, concurrently crawled listing of all accounts, web
+        properties and profiles that are accessible to a session.
+
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param ttl: Number of seconds a listing is cached, defaults to an hour.
+    :param max_workers: Number of listings that are retrieved concurrently.
+    :param attempts: Number of attempts for each page of a listing.
+
+    The hierarchy is crawled one level at a time, all web properties of
+    all accounts are listed concurrently and then all profiles of all web
+    properties. Only listings that are older than `ttl`, or whose parent
+    reports a different ``updated`` timestamp, are retrieved again. Pass
+    ``refresh=True`` to always list the accounts again, which picks up
+    changes below them with a minimal number of requests::
+
+        >>> directory = gaclient.ProfileDirectory(session)
+        >>> cursors = directory.cursors('2012-01-01', '2012-01-31', ['visits'])
+    '''
+
+    def __init__ (self, session, ttl=3600, max_workers=8, attempts=5):
+        self.session = session
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.attempts = attempts
+
+        self._cache = {}
+        self._lock = threading.Lock()
+
+
+    def accounts (self, refresh=False):
+        ''' Returns a list of all accounts. '''
+        return self._list('/accounts', force=refresh)
+
+
+    def webproperties (self, refresh=False):
+        ''' Returns a list of all web properties of all accounts. '''
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            return self._webproperties(pool, refresh)
+
+
+    def profiles (self, refresh=False):
+        ''' Returns a list of all profiles of all web properties. '''
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            webproperties = self._webproperties(pool, refresh)
+
+            return self._children(pool, webproperties, lambda w:
+                '/accounts/{}/webproperties/{}/profiles'.format(
+                    w['accountId'], w['id']))
+
+
+    def profile_ids (self, refresh=False):
+        ''' Returns the ids of all profiles. '''
+        return [p['id'] for p in self.profiles(refresh)]
+
+
+    def cursors (self, *args, **kwargs):
+        ''' Returns a :class:`Cursor` for each profile. The arguments are
+            passed to :class:`Cursor`, except for the session and profile.
+        '''
+        return [Cursor(self.session, profile_id, *args, **kwargs)
+            for profile_id in self.profile_ids()]
+
+
+    def clear (self):
+        ''' Forget all cached listings. '''
+        with self._lock:
+            self._cache = {}
+
+
+    def _webproperties (self, pool, refresh):
+        return self._children(pool, self.accounts(refresh), lambda a:
+            '/accounts/{}/webproperties'.format(a['id']))
+
+
+    def _children (self, pool, parents, path):
+        listings = pool.map(lambda parent: self._list(path(parent),
+            parent.get('updated')), parents)
+
+        return list(itertools.chain.from_iterable(listings))
+
+
+    def _list (self, path, updated=None, force=False):
+        with self._lock:
+            cached = self._cache.get(path)
+
+        if cached is not None and not force:
+            fetched, cached_updated, items = cached
+            if time.time() - fetched < self.ttl and cached_updated == updated:
+                return items
+
+        LOG.debug('Listing {}.'.format(path))
+        items = list(list_management(self.session, path,
+            attempts=self.attempts))
+
+        with self._lock:
+            self._cache[path] = (time.time(), updated, items)
+
+        return items
+
+
+class BatchTransport (object):
+    ''' Executes the requests of many cursors in multipart batch requests.
+
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param batch_size: Maximum number of requests in a single batch.
+    :param attempts: Number of attempts that are made for each request
+                     that fails with a retryable error.
+    :param max_workers: Number of batches that are sent concurrently.
+
+    Each batch is a single HTTP exchange, which saves a round trip per
+    request for queries that fit on a single page::
+
+        >>> batch = gaclient.BatchTransport(session)
+        >>> results = batch.fetch_all(directory.cursors(
+            '2012-01-01', '2012-01-31', ['visits']))
+    '''
+
+    def __init__ (self, session, batch_size=10, attempts=5, max_workers=4):
+        assert batch_size > 0 and attempts > 0
+
+        self.session = session
+        self.batch_size = batch_size
+        self.attempts = attempts
+        self.max_workers = max_workers
+
+
+    def execute (self, cursors):
+        ''' Execute the pending request of each cursor in `cursors` that
+            has not been executed yet.
+
+        :returns: A list of ``(cursor, exception)`` tuples for the requests
+                  that failed. Failed cursors are left unexecuted, so
+                  iterating over them falls back to a regular request.
+        '''
+        pending = [c for c in cursors if c._len is None]
+        failures = []
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            for attempt in range(self.attempts):
+                batches = [pending[i:i + self.batch_size]
+                    for i in range(0, len(pending), self.batch_size)]
+                retry = []
+
+                for batch, results in zip(batches, pool.map(self._send, batches)):
+                    for cursor, result in zip(batch, results):
+                        try:
+                            if isinstance(result, Exception):
+                                raise result
+                            cursor._load_response(result)
+
+                        except Exception as e:
+                            if _is_retryable(e) and attempt < self.attempts - 1:
+                                retry.append(cursor)
+                            else:
+                                failures.append((cursor, e))
+
+                if not retry:
+                    break
+
+                pending = retry
+                delay = 2 ** (attempt + random.random())
+                LOG.info('Retrying {} batched requests in {} seconds.'.format(
+                    len(retry), delay))
+                time.sleep(delay)
+
+        return failures
+
+
+    def fetch_all (self, cursors):
+        ''' Download all pages of each cursor in `cursors`. Pages are
+            retrieved in batches, requests that fail in a batch are
+            executed on their own.
+
+        :returns: A list with a list of rows for each cursor.
+        '''
+        results = [[] for _ in cursors]
+        pending = list(enumerate(cursors))
+
+        while pending:
+            self.execute([cursor for _, cursor in pending])
+
+            following = []
+            for i, cursor in pending:
+                results[i].extend(cursor)
+
+                next_cursor = cursor.next_cursor
+                if next_cursor is not None:
+                    following.append((i, next_cursor))
+
+            pending = following
+
+        return results
+
+
+    def _send (self, cursors):
+        ''' Send a single batch, returns a decoded response or an
+            exception for each cursor.
+        '''
+        boundary = 'batch_{:x}'.format(random.getrandbits(64))
+        parts = []
+
+        for i, cursor in enumerate(cursors):
+            url = urlparse(cursor._next_link)
+            parts.append(u'--{}\r\nContent-Type: application/http\r\n'
+                u'Content-ID: <item{}>\r\n\r\nGET {}?{}\r\n\r\n'.format(
+                    boundary, i, url.path, url.query))
+
+        parts.append(u'--{}--'.format(boundary))
+
+        headers = dict(REQUEST_HEADERS)
+        headers['Content-Type'] = 'multipart/mixed; boundary={}'.format(boundary)
+
+        LOG.info('Sending batch of {} requests.'.format(len(cursors)))
+        try:
+            response = self.session.post(BASEURLS['batch'],
+                data=u''.join(parts).encode('utf-8'), headers=headers)
+            responses = _parse_batch_response(
+                response.headers['Content-Type'], response.content)
+
+        except Exception as ex:
+            LOG.exception('Batch request failed.')
+            return [ex] * len(cursors)
+
+        return [responses.get('item{}'.format(i),
+            InvalidResponse('Batch response is missing a part.'))
+            for i in range(len(cursors))]
+
+
+def _parse_batch_response (content_type, body):
+    ''' Split a multipart batch response into its parts.
+
+    :returns: A dictionary that maps the content id of each request to
+              its decoded response, or to an exception if the request
+              failed.
+    '''
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise InvalidResponse('Expected multipart batch response.')
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    rv = {}
+    for part in body.split('--{}'.format(match.group(1))):
+        part = part.strip().replace('\r\n', '\n')
+        if not part or part == '--':
+            continue
+
+        headers, _, http = part.partition('\n\n')
+        head, _, payload = http.partition('\n\n')
+
+        content_id = re.search(r'Content-ID:\s*<response-([^>]+)>', headers, re.I)
+        if content_id is None:
+            continue
+
+        try:
+            status = int(head.split(None, 2)[1])
+            data = JSON_DECODER(payload)
+            _raise_for_error(data)
+
+            if status != 200:
+                raise AnalyticsError(status, head, [])
+
+        except Exception as ex:
+            data = ex
+
+        rv[content_id.group(1)] = data
+
+    return rv
+
+
+class HedgePolicy (object):
+    ''' Cuts tail latency by sending a duplicate of slow requests.
+
+    When a request has not completed after the `percentile` of recently
+    observed latencies, the same request is sent again and the response
+    that arrives first is used. The slower request is abandoned, its
+    response is discarded when it arrives.
+
+    :param percentile: Percentile of recent latencies after which a
+                       request is hedged.
+    :param budget: Maximum fraction of requests that may be hedged, this
+                   caps the additional quota that is spent on hedging.
+    :param window: Number of recent latencies that are kept.
+    :param min_samples: Requests are not hedged until this many latencies
+                        have been observed.
+    :param max_workers: Maximum number of duplicate requests in flight.
+                        Original requests are not limited.
+
+    A policy keeps statistics for a single session, pass the same
+    instance as `hedge` to all cursors of that session.
+    '''
+
+    def __init__ (self, percentile=95, budget=0.05, window=200,
+            min_samples=20, max_workers=16):
+        assert 0 < percentile < 100
+        assert 0 <= budget <= 1
+
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+
+        #: Number of requests sent through this policy.
+        self.requests = 0
+        #: Number of requests that were hedged.
+        self.hedges = 0
+
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers)
+
+
+    def delay (self):
+        ''' Returns the number of seconds after which a request is
+            hedged, or ``None`` if too few latencies have been observed.
+        '''
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        if len(latencies) < self.min_samples:
+            return None
+
+        return latencies[int(self.percentile / 100.0 * (len(latencies) - 1))]
+
+
+    def observe (self, latency):
+        ''' Record the latency of a completed request. '''
+        with self._lock:
+            self._latencies.append(latency)
+
+
+    def call (self, function, *args):
+        ''' Call `function` with `args`, and call it again if the first
+            call is slow. Returns the result of the first call that
+            succeeds.
+        '''
+        delay = self.delay()
+
+        with self._lock:
+            self.requests += 1
+            hedged = delay is not None and \
+                self.hedges + 1 <= self.budget * self.requests
+
+        start = time.time()
+
+        # Requests that cannot be hedged run in the calling thread.
+        if not hedged:
+            result = function(*args)
+            self.observe(time.time() - start)
+            return result
+
+        primary = self._start(function, args)
+        done, _ = wait([primary], timeout=delay)
+
+        if done or not self._acquire():
+            result = primary.result()
+            self.observe(time.time() - start)
+            return result
+
+        LOG.info('Hedging request after {:.3f} seconds.'.format(delay))
+
+        pending = [primary, self._pool.submit(function, *args)]
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [f for f in done if f.exception() is None]
+
+            if succeeded or not pending:
+                for other in pending:
+                    other.cancel()
+
+                self.observe(time.time() - start)
+                return (succeeded or list(done))[0].result()
+
+
+    def _start (self, function, args):
+        ''' Run `function` in a new thread, so that original requests do
+            not wait for each other in the pool of duplicates.
+        '''
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def run ():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
 
-        if not response['kind'] == 'analytics#gaData':
-            raise InvalidResponse('Expected data response.')
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
 
-        self._len = response['totalResults']
-        self._set_columns_from_response(response)
-        self._next_link = response.get('nextLink')
+        return future
 
-        self.sampled = self.sampled or response['containsSampledData']
 
-        if self._len == 0:
-            retval = []
-        else:
-            retval = [self._parse_row(row) for row in response['rows']]
+    def _acquire (self):
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
 
-        return retval
+            self.hedges += 1
+            return True
 
 
-    def _parse_row (self, row):
-        return {k: t(row[i]) for i, (k, t) in enumerate(self._columns)}
+class PageSizer (object):
+    ''' Chooses the number of rows per page from the observed download
+        speed, so that pages take about `target_latency` seconds.
 
+    :param target_latency: Desired number of seconds per page.
+    :param min_results: Smallest page size that is chosen.
+    :param max_results: Largest page size that is chosen.
+    :param max_bytes: Optional limit on the expected size of a page in bytes.
+    :param initial: Size of the first page, defaults to `max_results`.
+    :param smoothing: Weight of the latest observation in the moving
+                      averages of the download speed and row size.
 
-    def _set_columns_from_response (self, response):
-        headers = response['columnHeaders']
-        self._columns = [self._parse_header(h) for h in headers]
+    Wide rows result in large, slow pages that are likely to time out,
+    narrow rows in pages that are dominated by request overhead. Pass an
+    instance as `page_sizer` to a :class:`Cursor`, the size of each
+    following page is then adapted to the observations so far. Pages
+    grow by at most a factor two at a time, and are halved after a
+    failed request.
+    '''
 
+    def __init__ (self, target_latency=5.0, min_results=100,
+            max_results=10000, max_bytes=None, initial=None, smoothing=0.3):
+        assert 0 < min_results <= max_results <= 10000
 
-    def _parse_header (self, header):
-        type_ = header['dataType']
-        name = header['name']
+        self.target_latency = target_latency
+        self.min_results = min_results
+        self.max_results = max_results
+        self.max_bytes = max_bytes
+        self.smoothing = smoothing
 
-        try:
-            parser = DATATYPES[type_]
-        except KeyError:
-            raise UnsupportedDataType(type_)
+        #: The number of rows to request for the next page.
+        self.size = int(initial or max_results)
 
-        if name == 'ga:date':
-            parser = parse_date
+        #: Moving average of the number of rows downloaded per second.
+        self.rows_per_second = None
+        #: Moving average of the number of bytes per row.
+        self.bytes_per_row = None
 
-        return (remove_ga_prefix(name), parser)
+        self._lock = threading.Lock()
 
 
-    def __iter__ (self):
-        self.execute()
-        for row in self._row_buffer:
-            yield row
+    def observe (self, rows=0, seconds=0.0, nbytes=None, error=False):
+        ''' Record the outcome of a page request and update :attr:`size`.
 
-    def __len__ (self):
-        self.execute()
-        return self._len
+        :param rows: Number of rows on the page.
+        :param seconds: Duration of the request.
+        :param nbytes: Size of the response in bytes.
+        :param error: ``True`` if the request failed.
+        '''
+        with self._lock:
+            if error:
+                self.size = max(self.min_results, self.size // 2)
+                return
 
+            # Short last pages say little about the download speed.
+            if rows == 0 or seconds <= 0 or rows < self.size // 2:
+                return
 
-class ResponseIterator (object):
-    ''' Automatically iterates over all pages of a Cursor.
+            self.rows_per_second = self._average(self.rows_per_second,
+                rows / float(seconds))
 
-    :param cursor: A :class:`Cursor` instance.
-    :param limit: Optional limit on the number of results that are
-                  yielded.
-    '''
+            size = self.target_latency * self.rows_per_second
 
-    def __init__ (self, cursor, limit=None):
-        self.cursor = cursor
-        self.limit = limit
-        self._index = 0
+            if nbytes:
+                self.bytes_per_row = self._average(self.bytes_per_row,
+                    nbytes / float(rows))
 
-        LOG.info('Initialize ResponseIterator with limit={}'.format(
-            self.limit))
+                if self.max_bytes:
+                    size = min(size, self.max_bytes / self.bytes_per_row)
 
+            size = min(size, 2 * self.size)
+            self.size = int(max(self.min_results, min(self.max_results, size)))
 
-    def _raise_on_limit (self):
-        self._index += 1
-        if self.limit and self._index > self.limit:
-            LOG.info('ResponseIterator limit reached.')
-            raise StopIteration()
+        LOG.debug('Next page size is {} rows.'.format(self.size))
 
 
-    def __iter__ (self):
-        while self.cursor:
-            for row in self.cursor:
-                self._raise_on_limit()
-                yield row
+    def _average (self, average, value):
+        if average is None:
+            return value
 
-            self.cursor = self.cursor.next_cursor
+        return self.smoothing * value + (1 - self.smoothing) * average
 
 
 def build_data_query (profile_id, start_date, end_date, metrics,
         dimensions=None, sort=None, filters=None, max_results=10000,
-        start_index=1):
+        start_index=1, fields=PAGE_FIELDS, catalog=None):
     ''' Build the parameters dictionary for a data query.
 
     :param profile_id: The Google Analytics profile id to query.
@@ -298,6 +2547,12 @@ def build_data_query (profile_id, start_date, end_date, metrics,
     :param filters: Optional list of filter predicates.
     :param max_results: Maximum number of results.
     :param start_index: The index of the first element to retrieve.
+    :param fields: The top-level fields of the response to retrieve, by
+                   default :data:`PAGE_FIELDS`. Add ``totalsForAllResults``
+                   to retrieve totals, or pass ``None`` to retrieve the
+                   complete response.
+    :param catalog: Optional :class:`MetadataCatalog` the query is
+                    validated against.
 
     `start_date` and `end_date` should be :class:`datetime.datetime` or
     :class:`datetime.date` objects, or strings in ``yyyy-mm-dd`` or
@@ -309,12 +2564,15 @@ def build_data_query (profile_id, start_date, end_date, metrics,
     :returns: A dictionary of query parameters.
 
     :raises: A :class:`InvalidDateRange` is raised if the specified data
-             range is invalid.
+             range is invalid. If a `catalog` is given and it rejects the
+             query an :class:`InvalidQuery` is raised.
     '''
-    assert isinstance(metrics, list)
-    assert dimensions is None or isinstance(dimensions, list)
+    assert isinstance(metrics, list) and len(metrics) <= MAX_METRICS
+    assert dimensions is None or (isinstance(dimensions, list)
+        and len(dimensions) <= MAX_DIMENSIONS)
     assert sort is None or isinstance(sort, list)
     assert filters is None or isinstance(filters, list)
+    assert fields is None or isinstance(fields, list)
     assert 0 < int(max_results) <= 10000
     assert int(start_index) > 0
 
@@ -355,15 +2613,28 @@ def build_data_query (profile_id, start_date, end_date, metrics,
     if filters:
         params['filters'] = u','.join(filters)
 
+    if fields:
+        params['fields'] = u','.join(fields)
+
+    if catalog is not None:
+        catalog.validate(params)
+
     return params
 
 
-def execute_request (session, url):
+def execute_request (session, url, decoder=None, hedge=None):
     ''' Execute a ``GET`` request against `url` within the context
         of `session`.
 
     :param session: An authorized OAuth2 session, see :func:`build_session`.
     :param url: The URL to ``GET``.
+    :param decoder: Optional function that decodes the response body,
+                    defaults to :data:`JSON_DECODER`.
+    :param hedge: Optional :class:`HedgePolicy` the request is sent with.
+
+    The request is sent with :data:`REQUEST_HEADERS`, so the response is
+    transferred gzip compressed. The body is passed to the decoder as
+    bytes without decoding it to text first.
 
     :returns: A dictionary of data returned by the API if valid JSON data
               was returned.
@@ -372,21 +2643,149 @@ def execute_request (session, url):
              was not valid JSON. If the API returns an error then a
              :class:`AnalyticsError` is raised.
     '''
+    return _decode_response(_get_content(session, url, hedge), url, decoder)
+
+
+def _decode_response (body, url, decoder=None):
+    try:
+        data = (decoder or JSON_DECODER)(body)
+
+    except ValueError as ex:
+        LOG.exception('Invalid response for request url={}'.format(url))
+        raise
+
+    _raise_for_error(data)
+
+    return data
+
+
+def parse_page (body, decoder=None, headers=None, convert=True):
+    ''' Decode the body of a data response and convert its rows.
+
+    This function is executed by the `parse_pool` of a :class:`Cursor`,
+    usually in another process. It only uses picklable arguments and
+    return values.
+
+    :param body: The raw response body.
+    :param decoder: Optional function that decodes `body`, defaults to
+                    :data:`JSON_DECODER`.
+    :param headers: Column headers of the first page, used when the
+                    response contains no ``columnHeaders``.
+    :param convert: If ``False`` the rows are returned as lists of the
+                    raw values, so that they can be converted lazily.
+
+    :returns: A dictionary with the ``totalResults``, ``nextLink``,
+              ``containsSampledData``, ``totalsForAllResults`` and
+              ``columnHeaders`` of the response, and its ``rows`` as
+              tuples of Python values.
+
+    :raises: The same exceptions as :func:`execute_request`, or
+             :class:`InvalidResponse` if `body` is not a data response.
+    '''
+    data = (decoder or JSON_DECODER)(body)
+    _raise_for_error(data)
+
+    if not data['kind'] == 'analytics#gaData':
+        raise InvalidResponse('Expected data response.')
+
+    headers = data.get('columnHeaders', headers)
+    if headers is None:
+        raise InvalidResponse('Response contains no column headers.')
+
+    parsers = [_column_parser(h)[1] for h in headers]
+    rows = data.get('rows', [])
+
+    if convert:
+        rows = [tuple(p(v) for p, v in zip(parsers, row)) for row in rows]
+
+    return {
+        'totalResults': data['totalResults'],
+        'nextLink': data.get('nextLink'),
+        'containsSampledData': data['containsSampledData'],
+        'totalsForAllResults': data.get('totalsForAllResults'),
+        'columnHeaders': headers,
+        'rows': rows,
+    }
+
+
+def _get_content (session, url, hedge=None):
+    ''' Returns the raw body of a ``GET`` request against `url`. '''
+    if hedge is not None:
+        return hedge.call(_get_content, session, url)
+
     LOG.debug('Executing request url="{}".'.format(url))
     try:
-        data = session.get(url).json()
+        return session.get(url, headers=REQUEST_HEADERS).content
 
     except Exception as ex:
         LOG.exception('request url={}'.format(url))
         raise
 
+
+def _is_retryable (error):
+    ''' Returns ``True`` if the request that raised `error` should be
+        retried.
+    '''
+    if isinstance(error, AnalyticsError):
+        reasons = [e.get('reason') for e in error.errors or ()
+            if isinstance(e, dict)]
+        return (isinstance(error.code, int) and error.code >= 500) or \
+            any(r in RETRY_REASONS for r in reasons)
+
+    return isinstance(error, _network_errors())
+
+
+def _is_overloaded (error):
+    ''' Returns ``True`` if `error` suggests that a page was too large to
+        serve in time, which is the case for timeouts, connection errors
+        and server errors. Rate limit and quota errors are not.
+    '''
+    if isinstance(error, AnalyticsError):
+        reasons = [e.get('reason') for e in error.errors or ()
+            if isinstance(e, dict)]
+
+        if any(r in ('rateLimitExceeded', 'userRateLimitExceeded',
+                'quotaExceeded') for r in reasons):
+            return False
+
+        return (isinstance(error.code, int) and error.code >= 500) or \
+            any(r in ('backendError', 'internalError') for r in reasons)
+
+    return not isinstance(error, ValueError)
+
+
+def _raise_for_error (data):
     e = data.get('error')
     if e:
         LOG.error('Analytics reported an error code={}, message="{}".'.format(
             e.get('code'), e.get('message')))
         raise AnalyticsError(e['code'], e['message'], e['errors'])
 
-    return data
+
+def _column_parser (header):
+    ''' Returns the column name and a parser for a column header. '''
+    type_ = header['dataType']
+    name = header['name']
+
+    try:
+        parser = DATATYPES[type_]
+    except KeyError:
+        raise UnsupportedDataType(type_)
+
+    if name == 'ga:date':
+        parser = _parse_ga_date
+
+    return (remove_ga_prefix(name), parser)
+
+
+def _parse_ga_date (value):
+    ''' Fast path of :func:`parse_date` for ``yyyymmdd`` dates as they
+        are returned by Google Analytics.
+    '''
+    try:
+        return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        return parse_date(value)
 
 
 def remove_ga_prefix (val):
@@ -482,6 +2881,8 @@ def build_session (client_id, client_secret, token, update_token=None):
 
     :returns: An OAuth2 session.
     '''
+    from requests_oauthlib import OAuth2Session
+
     orig_token = token.copy()
 
     LOG.debug('Creating OAuth 2.0 session.')
@@ -499,6 +2900,7 @@ def build_session (client_id, client_secret, token, update_token=None):
     session = OAuth2Session(client_id, token=token,
         auto_refresh_url=REFRESH_URL, auto_refresh_kwargs=extra,
         token_updater=token_updater)
+    session.headers.update(REQUEST_HEADERS)
 
     if token.get('access_token') is None:
         token = session.refresh_token(REFRESH_URL, **extra)
@@ -520,6 +2922,8 @@ def generate_consent_url (client_id, redirect_uri, scope='read-only'):
 
     :returns: A URI.
     '''
+    from requests_oauthlib import OAuth2Session
+
     scope_ = [SCOPES[scope]]
 
     session = OAuth2Session(client_id, redirect_uri=redirect_uri,
@@ -532,3 +2936,736 @@ def generate_consent_url (client_id, redirect_uri, scope='read-only'):
     return authorization_url
 
 
+
+
+def shard_dates (start_date, end_date, period='month'):
+    ''' Split a date range into consecutive shards.
+
+    :param start_date: Start date of the range.
+    :param end_date: End date of the range, inclusive.
+    :param period: One of ``day``, ``week`` or ``month``. Weeks end on
+                   sunday, the first and last shard may be partial.
+
+    :returns: A list of ``(start, end)`` tuples of :class:`datetime.date`
+              objects that together cover the range.
+    '''
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+
+    if period not in ('day', 'week', 'month'):
+        raise ValueError('Unknown period: {}'.format(period))
+
+    shards = []
+
+    while start_date <= end_date:
+        if period == 'day':
+            last = start_date
+        elif period == 'week':
+            last = start_date + datetime.timedelta(days=6 - start_date.weekday())
+        else:
+            following = (start_date.replace(day=28) + datetime.timedelta(days=4))
+            last = following.replace(day=1) - datetime.timedelta(days=1)
+
+        last = min(last, end_date)
+        shards.append((start_date, last))
+        start_date = last + datetime.timedelta(days=1)
+
+    return shards
+
+
+class RateLimiter (object):
+    ''' A token bucket that limits the rate of requests.
+
+    :param rate: Number of requests per second.
+    :param burst: Number of requests that may be sent at once.
+
+    :meth:`acquire` is safe to call from multiple threads.
+    '''
+
+    def __init__ (self, rate, burst=1):
+        assert rate > 0 and burst >= 1
+
+        self.rate = float(rate)
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+
+    def acquire (self):
+        ''' Block until a request may be sent. Returns the number of
+            seconds that were waited.
+        '''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # Tokens are reserved ahead, so waiting threads are served
+            # in the order in which they arrived.
+            self._tokens -= 1
+            delay = max(0.0, -self._tokens / self.rate)
+
+        if delay:
+            time.sleep(delay)
+
+        return delay
+
+
+#: A task of a :class:`WorkQueue`, a single page of a query for one
+#: profile and date shard.
+Task = collections.namedtuple('Task', ['id', 'name', 'profile_id',
+    'start_date', 'end_date', 'start_index', 'query', 'attempts'])
+
+
+class WorkQueue (object):
+    ''' A durable queue of backfill tasks in a SQLite database, shared
+        by any number of worker processes.
+
+    :param path: Path of the database, it is created if necessary.
+    :param lease: Number of seconds a claimed task is reserved for a
+                  worker. Tasks of workers that crash are claimed again
+                  once their lease expires.
+    :param max_attempts: Number of times a task is claimed before it is
+                         marked as failed.
+    :param retry_delay: Failed tasks are not claimed again for
+                        `retry_delay` seconds, doubling with every
+                        attempt, so that all workers back off together.
+    :param owner: Name of this worker, defaults to the host name and
+                  process id.
+
+    Queries are split into tasks of a single page for one profile and
+    date shard. A task is added once, adding it again has no effect, and
+    completing a page adds the task of the following page::
+
+        >>> queue = gaclient.WorkQueue('backfill.db')
+        >>> queue.enqueue('visits', ['12345', '67890'], '2012-01-01',
+        ...     '2013-12-31', ['visits'], ['date', 'source'])
+        >>> gaclient.run_worker(queue, session, write_rows)
+
+    A shared quota budget limits the number of requests of all workers,
+    see :meth:`set_budget`. Workers on several machines can share a
+    database on a file system that supports locking, their clocks should
+    be synchronized since leases expire by wall clock time.
+    '''
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            profile_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            start_index INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            state TEXT NOT NULL,
+            owner TEXT,
+            expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            UNIQUE (name, profile_id, start_date, end_date, start_index))''',
+        '''CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)''',
+        '''CREATE TABLE IF NOT EXISTS quota (
+            name TEXT PRIMARY KEY,
+            budget INTEGER,
+            used INTEGER NOT NULL DEFAULT 0)''',
+    )
+
+    def __init__ (self, path, lease=600, max_attempts=5, owner=None,
+            retry_delay=1.0):
+        import socket
+        import sqlite3
+
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.owner = owner or u'{}:{}:{:08x}'.format(socket.gethostname(),
+            os.getpid(), random.getrandbits(32))
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+
+        with self._transaction() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+
+    @contextlib.contextmanager
+    def _transaction (self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+
+
+    def _insert (self, db, name, profile_id, start_date, end_date, query,
+            start_index):
+        cursor = db.execute('''INSERT OR IGNORE INTO tasks (name,
+            profile_id, start_date, end_date, start_index, query, state)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending')''', (name,
+            remove_ga_prefix(unicode(profile_id)), str(parse_date(start_date)),
+            str(parse_date(end_date)), start_index,
+            json.dumps(query, sort_keys=True)))
+
+        return cursor.rowcount == 1
+
+
+    def add (self, name, profile_id, start_date, end_date, query,
+            start_index=1):
+        ''' Add a single task.
+
+        :param name: Name of the query the task belongs to.
+        :param query: A dictionary of the arguments of :func:`build_data_query`
+                      other than the profile and dates.
+
+        :returns: ``False`` if the task already exists.
+        '''
+        with self._transaction() as db:
+            return self._insert(db, name, profile_id, start_date, end_date,
+                query, start_index)
+
+
+    def enqueue (self, name, profile_ids, start_date, end_date, metrics,
+            dimensions=None, period='month', **kwargs):
+        r''' Add the tasks of the first page of a query for each profile
+            and date shard.
+
+        :param name: Name of the query, it identifies the tasks together
+                     with the profile and dates.
+        :param profile_ids: List of profile ids.
+        :param period: Size of the date shards, see :func:`shard_dates`.
+        :param \*\*kwargs: Passed to :func:`build_data_query`.
+
+        :returns: The number of tasks that were added.
+        '''
+        query = dict(kwargs, metrics=metrics, dimensions=dimensions)
+        shards = shard_dates(start_date, end_date, period)
+
+        with self._transaction() as db:
+            return sum(self._insert(db, name, profile_id, start, end, query, 1)
+                for profile_id in profile_ids for start, end in shards)
+
+
+    def claim (self, lease=None):
+        ''' Claim the oldest pending task, or a task whose lease has
+            expired.
+
+        :returns: A :class:`Task`, or ``None`` if no task is available.
+        '''
+        now = time.time()
+
+        with self._transaction() as db:
+            db.execute('''UPDATE tasks SET state = 'failed',
+                error = 'Lease expired.' WHERE state = 'leased'
+                AND expires < ? AND attempts >= ?''',
+                (now, self.max_attempts))
+
+            row = db.execute('''SELECT id, name, profile_id, start_date,
+                end_date, start_index, query, attempts FROM tasks
+                WHERE (state = 'pending' AND (expires IS NULL OR expires <= ?))
+                OR (state = 'leased' AND expires < ?)
+                ORDER BY id LIMIT 1''', (now, now)).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute('''UPDATE tasks SET state = 'leased', owner = ?,
+                expires = ?, attempts = attempts + 1 WHERE id = ?''',
+                (self.owner, now + (lease or self.lease), row[0]))
+
+        return Task(row[0], row[1], row[2], row[3], row[4], row[5],
+            json.loads(row[6]), row[7] + 1)
+
+
+    def _update (self, task, assignments, params=()):
+        ''' Update `task` if it is still leased by this worker. '''
+        cursor = self._db.execute('''UPDATE tasks SET {} WHERE
+            state = 'leased' AND id = ? AND owner = ?'''.format(assignments),
+            tuple(params) + (task.id, self.owner))
+
+        return cursor.rowcount == 1
+
+
+    def renew (self, task, lease=None):
+        ''' Extend the lease of `task`.
+
+        :returns: ``False`` if the lease was lost to another worker.
+        '''
+        with self._transaction():
+            return self._update(task, 'expires = ?',
+                (time.time() + (lease or self.lease),))
+
+
+    def complete (self, task, next_index=None):
+        ''' Mark `task` as done.
+
+        :param next_index: Start index of the following page, if any. Its
+                           task is added in the same transaction.
+
+        :returns: ``False`` if the lease was lost to another worker.
+        '''
+        with self._transaction() as db:
+            if not self._update(task, "state = 'done', expires = NULL"):
+                return False
+
+            if next_index is not None:
+                self._insert(db, task.name, task.profile_id, task.start_date,
+                    task.end_date, task.query, next_index)
+
+            return True
+
+
+    def fail (self, task, error, retry=True):
+        ''' Return `task` to the queue after a backoff delay, or mark it
+            as failed after `max_attempts` attempts.
+
+        :param retry: If ``False`` the task is marked as failed at once,
+                      for errors that would fail again.
+        '''
+        state = 'pending'
+        if not retry or task.attempts >= self.max_attempts:
+            state = 'failed'
+
+        delay = self.retry_delay * (2 ** (task.attempts - 1 + random.random()))
+
+        with self._transaction():
+            return self._update(task, 'state = ?, expires = ?, error = ?',
+                (state, time.time() + delay, unicode(error)))
+
+
+    def release (self, task):
+        ''' Return `task` to the queue without counting the attempt. '''
+        with self._transaction():
+            return self._update(task, '''state = 'pending', expires = NULL,
+                attempts = attempts - 1''')
+
+
+    def counts (self):
+        ''' Returns a dictionary with the number of tasks in each state,
+            ``pending``, ``leased``, ``done`` or ``failed``.
+        '''
+        with self._transaction() as db:
+            return dict(db.execute(
+                'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+
+
+    def set_budget (self, budget, name='default'):
+        ''' Set the number of requests all workers may make against the
+            quota `name`, ``None`` removes the limit.
+        '''
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO quota (name) VALUES (?)', (name,))
+            db.execute('UPDATE quota SET budget = ? WHERE name = ?',
+                (budget, name))
+
+
+    def consume (self, requests=1, name='default'):
+        ''' Take `requests` from the quota `name`.
+
+        :returns: ``False``, without taking anything, if the budget would
+                  be exceeded.
+        '''
+        with self._transaction() as db:
+            row = db.execute('SELECT budget, used FROM quota WHERE name = ?',
+                (name,)).fetchone()
+
+            if row is not None and row[0] is not None \
+                    and row[1] + requests > row[0]:
+                return False
+
+            db.execute('INSERT OR IGNORE INTO quota (name) VALUES (?)', (name,))
+            db.execute('UPDATE quota SET used = used + ? WHERE name = ?',
+                (requests, name))
+
+            return True
+
+
+    def used (self, name='default'):
+        ''' Returns the number of requests taken from the quota `name`. '''
+        with self._transaction() as db:
+            row = db.execute('SELECT used FROM quota WHERE name = ?',
+                (name,)).fetchone()
+
+        return row[0] if row else 0
+
+
+    def close (self):
+        self._db.close()
+
+
+def run_worker (queue, session, sink, quota='default', max_tasks=None,
+        poll=None, **kwargs):
+    r''' Execute the tasks of a :class:`WorkQueue` until it is empty.
+
+    :param queue: A :class:`WorkQueue`.
+    :param session: An authorized OAuth2 session, see :func:`build_session`.
+    :param sink: Called with the :class:`Task` and the list of rows of
+                 each page that is downloaded.
+    :param quota: Name of the quota every request is taken from, or
+                  ``None``. The worker stops when the budget is exhausted.
+    :param max_tasks: Optional maximum number of tasks to complete.
+    :param poll: If given, the worker waits `poll` seconds and tries again
+                 when no task can be claimed but tasks are delayed or
+                 leased by other workers. By default it returns.
+    :param \*\*kwargs: Passed to every :class:`Cursor`.
+
+    Each claim sends a single request, the `attempts` of the cursors is
+    always 1. Failed pages are retried by the queue, see `max_attempts`
+    and `retry_delay` of :class:`WorkQueue`. Requests that fail with an
+    error that is not retryable, such as an invalid query, fail their
+    task at once. Errors raised by `sink` are always retried.
+
+    A task is completed after `sink` returns, so a page is written again
+    if a worker stops in between. Writes should be keyed by the task, for
+    example by writing each page to a file named after :attr:`Task.id`.
+
+    :returns: The number of completed tasks.
+    '''
+    completed = 0
+
+    while max_tasks is None or completed < max_tasks:
+        task = queue.claim()
+        if task is None:
+            counts = queue.counts()
+            if poll is None or not (counts.get('pending') or counts.get('leased')):
+                break
+
+            time.sleep(poll)
+            continue
+
+        if quota is not None and not queue.consume(1, quota):
+            LOG.warning('Quota {} is exhausted.'.format(quota))
+            queue.release(task)
+            break
+
+        # Retries are left to the queue, so that every request is taken
+        # from the quota and a page never outlives its lease.
+        query = dict(task.query, **kwargs)
+        query['attempts'] = 1
+
+        try:
+            cursor = Cursor(session, task.profile_id, task.start_date,
+                task.end_date, start_index=task.start_index, **query)
+            rows = list(cursor)
+
+        except Exception as e:
+            LOG.exception('Request of task {} failed.'.format(task.id))
+            queue.fail(task, e, retry=_is_retryable(e))
+            continue
+
+        if not queue.renew(task):
+            LOG.warning('Lost the lease of task {}.'.format(task.id))
+            continue
+
+        try:
+            sink(task, rows)
+
+        except Exception as e:
+            LOG.exception('Task {} failed.'.format(task.id))
+            queue.fail(task, e)
+            continue
+
+        next_index = None
+        if cursor._next_link:
+            next_index = cursor.params['start-index'] + cursor.params['max-results']
+
+        if queue.complete(task, next_index):
+            completed += 1
+
+    return completed
+
+
+class _MeteredSession (object):
+    ''' Wraps a session to count, and optionally rate limit, its
+        requests.
+    '''
+
+    def __init__ (self, session, limiter=None):
+        self.session = session
+        self.limiter = limiter
+        self.requests = 0
+        self._lock = threading.Lock()
+
+
+    def get (self, *args, **kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        with self._lock:
+            self.requests += 1
+
+        return self.session.get(*args, **kwargs)
+
+
+    def __getattr__ (self, name):
+        return getattr(self.session, name)
+
+
+class _ExportWriter (object):
+    ''' Appends rows to a CSV or JSON lines file, the file is created
+        when the first page is written.
+    '''
+
+    def __init__ (self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self._fp = None
+        self._csv = None
+        self._lock = threading.Lock()
+
+
+    def write (self, names, rows):
+        with self._lock:
+            if self._fp is None:
+                self._open(names)
+
+            for row in rows:
+                if self._csv is not None:
+                    self._csv.writerow([row[name] for name in names])
+                else:
+                    self._fp.write(json.dumps(
+                        dict((name, row[name]) for name in names),
+                        default=str, sort_keys=True))
+                    self._fp.write('\n')
+
+            self.rows += len(rows)
+
+
+    def _open (self, names):
+        if PY3:
+            self._fp = open(self.path, 'w', newline='')
+        else:
+            self._fp = open(self.path, 'wb')
+
+        if self.fmt == 'csv':
+            self._csv = csv.writer(self._fp)
+            self._csv.writerow(names)
+
+
+    def close (self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+class _ExportProgress (object):
+    ''' Throughput counters of an export. '''
+
+    def __init__ (self, session):
+        self.session = session
+        self.rows = 0
+        self.pages = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+
+    def add (self, rows):
+        with self._lock:
+            self.rows += rows
+            self.pages += 1
+
+
+    def report (self):
+        elapsed = max(time.time() - self.start, 1e-6)
+
+        return u'{} rows ({:.0f}/s), {} pages ({:.1f}/s), {} requests'.format(
+            self.rows, self.rows / elapsed, self.pages, self.pages / elapsed,
+            self.session.requests)
+
+
+# Keys of a job file query that select what is exported, and the keys
+# that are passed on to build_data_query.
+_JOB_KEYS = ('name', 'profile_id', 'profile_ids', 'shard', 'start_date',
+    'end_date')
+_JOB_QUERY_KEYS = ('metrics', 'dimensions', 'sort', 'filters', 'max_results',
+    'start_index', 'fields')
+
+
+def _export_shard (session, query, profile_id, start_date, end_date, writer,
+        progress, tag=False):
+    ''' Download all pages of a query for a single profile and date
+        shard. If `tag` is ``True`` a ``profile_id`` column is added.
+        Returns the number of rows.
+    '''
+    cursor = Cursor(session, profile_id, start_date, end_date,
+        **dict((k, v) for k, v in query.items() if k in _JOB_QUERY_KEYS))
+    count = 0
+
+    for page in ResponseIterator(cursor).pages():
+        page.execute()
+        rows = list(page)
+        names = page._schema.names
+
+        if tag:
+            names = ('profile_id',) + names
+            for row in rows:
+                row['profile_id'] = profile_id
+
+        writer.write(names, rows)
+        progress.add(len(rows))
+        count += len(rows)
+
+    return count
+
+
+def _build_parser ():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='gaclient',
+        description='Export Google Analytics data to CSV or JSON lines files.')
+
+    parser.add_argument('job', help='JSON file with the credentials and '
+        'queries to export.')
+    parser.add_argument('-o', '--output-dir', default='.',
+        help='Directory the files are written to, one per query.')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+        default='jsonl', help='Output format.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+        help='Number of requests in flight.')
+    parser.add_argument('-s', '--shard', choices=['none', 'day', 'week',
+        'month'], default='none', help='Split the date range of each query.')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+        help='Maximum number of requests per second.')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='Do not report progress.')
+
+    return parser
+
+
+def main (argv=None):
+    ''' Entry point of the ``gaclient`` command, which exports the
+        queries of a job file.
+
+    :param argv: Command line arguments, defaults to ``sys.argv[1:]``.
+
+    The job file is a JSON object with the credentials passed to
+    :func:`build_session` and a list of queries, which take the
+    arguments of :func:`build_data_query`, except for `catalog`. A
+    query may also set its own ``shard`` period. A query selects either a
+    single ``profile_id`` or a list of ``profile_ids``, queries without
+    either use the top-level ``profiles``::
+
+        {
+            "client_id": "...",
+            "client_secret": "...",
+            "token": {"refresh_token": "..."},
+            "profiles": ["12345", "67890"],
+            "queries": [{
+                "name": "visits",
+                "start_date": "2014-01-01",
+                "end_date": "2014-03-31",
+                "metrics": ["visits"],
+                "dimensions": ["date", "source"]
+            }]
+        }
+
+    The rows of each query are written to ``<name>.csv`` or
+    ``<name>.jsonl`` as pages arrive, with a ``profile_id`` column if the
+    query selects a list of profiles. The rows of different profiles and
+    shards may be interleaved. The status of each query is reported per
+    profile.
+
+    :returns: ``0`` if all queries succeeded, ``1`` otherwise.
+    '''
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+
+    with open(args.job) as fp:
+        job = json.load(fp)
+
+    limiter = RateLimiter(args.rate) if args.rate else None
+    session = _MeteredSession(build_session(job['client_id'],
+        job['client_secret'], job['token']), limiter)
+    progress = _ExportProgress(session)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    queries = []
+    for i, query in enumerate(job['queries']):
+        name = query.get('name', u'query-{}'.format(i + 1))
+
+        unknown = set(query) - set(_JOB_KEYS + _JOB_QUERY_KEYS)
+        if unknown:
+            parser.error(u'Query {} has unknown keys: {}.'.format(name,
+                u', '.join(sorted(unknown))))
+        writer = _ExportWriter(os.path.join(args.output_dir,
+            u'{}.{}'.format(name, args.format)), args.format)
+
+        shard = query.get('shard', args.shard)
+        if shard == 'none':
+            shards = [(query['start_date'], query['end_date'])]
+        else:
+            shards = shard_dates(query['start_date'], query['end_date'], shard)
+
+        if 'profile_id' in query:
+            profiles, tag = [query['profile_id']], False
+        else:
+            profiles, tag = query.get('profile_ids', job.get('profiles')), True
+
+        if not profiles:
+            parser.error(u'Query {} selects no profiles.'.format(name))
+
+        queries.append((name, query, writer, shards, profiles, tag))
+
+    done = threading.Event()
+
+    def report ():
+        while not done.wait(1.0):
+            sys.stderr.write(u'\r{}'.format(progress.report()))
+            sys.stderr.flush()
+
+    if not args.quiet:
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [((name, profile_id), pool.submit(_export_shard, session,
+            query, profile_id, start, end, writer, progress, tag))
+            for name, query, writer, shards, profiles, tag in queries
+            for profile_id in profiles
+            for start, end in shards]
+
+        errors = {}
+        rows = collections.defaultdict(int)
+        for key, future in futures:
+            try:
+                rows[key] += future.result()
+            except Exception as e:
+                LOG.exception('Query {} of profile {} failed.'.format(*key))
+                errors.setdefault(key, e)
+
+    done.set()
+
+    if not args.quiet:
+        sys.stderr.write(u'\r{}\n'.format(progress.report()))
+
+    for name, query, writer, shards, profiles, tag in queries:
+        writer.close()
+
+        for profile_id in profiles:
+            key = (name, profile_id)
+            if key in errors:
+                sys.stderr.write(u'{} {}: failed: {}\n'.format(name,
+                    profile_id, errors[key]))
+            else:
+                sys.stderr.write(u'{} {}: ok, {} rows\n'.format(name,
+                    profile_id, rows[key]))
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,5 @@
 
-from distutils.core import setup
+from setuptools import setup
 
 import re
 
@@ -34,4 +34,8 @@ setup(name='gaclient',
     ],
     keywords = ('google analytics'),
     py_modules=['gaclient'],
-    install_requires=['requests_oauthlib>=0.4.0'])
+    entry_points={
+        'console_scripts': ['gaclient = gaclient:main'],
+    },
+    install_requires=['requests_oauthlib>=0.4.0',
+        'futures; python_version < "3"'])
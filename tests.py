@@ -1,6 +1,14 @@
 
 import datetime
+import io
 import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 from nose.tools import ok_, eq_, assert_raises, raises
 
@@ -10,11 +18,14 @@ import gaclient as gc
 
 class MockSession (object):
 
-    def __init__ (self, data):
+    def __init__ (self, data, content=None, headers=None):
         self.data = data
+        self.content = content or json.dumps(data).encode('utf-8')
+        self.headers = headers
 
 
     def get (self, *args, **kwargs):
+        self.headers = kwargs.get('headers')
         return self
 
 
@@ -86,9 +97,21 @@ class TestExecuteRequest (object):
 
     @raises(ValueError)
     def test_invalid_json (self):
-        session = MockSession('foo')
-        session.json = lambda: json.loads('foobar')
+        session = MockSession('foo', content=b'foobar')
+        gc.execute_request(session, '')
+
+
+    def test_requests_gzip (self):
+        session = MockSession({})
         gc.execute_request(session, '')
+        eq_('gzip', session.headers['Accept-Encoding'])
+        ok_('gzip' in session.headers['User-Agent'])
+
+
+    def test_custom_decoder (self):
+        session = MockSession({}, content=b'raw')
+        eq_({'body': b'raw'}, gc.execute_request(session, '',
+            decoder=lambda body: {'body': body}))
 
 
 
@@ -132,6 +155,8 @@ class TestBuildDataQuery (object):
             'ids': 'ga:profile_id',
             'metrics': 'ga:visits',
             'max-results': 42,
+            'start-index': 1,
+            'fields': 'kind,totalResults,columnHeaders,nextLink,containsSampledData,rows',
             'start-date': '2012-01-01'
         }
 
@@ -144,6 +169,8 @@ class TestBuildDataQuery (object):
             'ids': 'ga:profile_id',
             'metrics': 'ga:visits',
             'max-results': 1,
+            'start-index': 1,
+            'fields': 'kind,totalResults,columnHeaders,nextLink,containsSampledData,rows',
             'start-date': '2012-01-01'
         }
         eq_(R, gc.build_data_query('profile_id', '2012-01-01', '2012-01-01', ['ga:visits'], max_results=1))
@@ -155,6 +182,8 @@ class TestBuildDataQuery (object):
             'ids': 'ga:profile_id',
             'metrics': 'ga:visits',
             'max-results': 10000,
+            'start-index': 1,
+            'fields': 'kind,totalResults,columnHeaders,nextLink,containsSampledData,rows',
             'start-date': '2012-01-01'
         }
         eq_(R, gc.build_data_query('profile_id', '2012-01-01', '2012-01-01', ['ga:visits'], max_results=10000))
@@ -184,9 +213,1261 @@ class TestBuildDataQuery (object):
             'sort': '-ga:date,ga:bounces',
             'filters': 'ga:bounces==1,ga:visits<10',
             'max-results': 5,
+            'start-index': 1,
+            'fields': 'kind,totalResults,nextLink',
         }
 
         eq_(R, gc.build_data_query('123456', '2012-01-01', '20130101', ['ga:visits', 'bounces'],
             ['date', 'ga:keyword'], ['-date', 'ga:bounces'], ['bounces==1', 'ga:visits<10'],
-            5))
+            5, fields=['kind', 'totalResults', 'nextLink']))
+
+
+    def test_complete_response (self):
+        ok_('fields' not in gc.build_data_query('1', '2012-01-01', '2012-01-01',
+            ['visits'], fields=None))
+
+
+
+class MockResponse (object):
+
+    def __init__ (self, data):
+        self.data = data
+
+
+    def json (self):
+        return self.data
+
+
+    @property
+    def content (self):
+        return json.dumps(self.data).encode('utf-8')
+
+
+
+class FakeAnalytics (object):
+    ''' A session that serves data queries from an in-memory table. '''
+
+    DATATYPES = {'ga:date': 'STRING', 'ga:source': 'STRING'}
+
+    def __init__ (self, days=10, sample_days=None):
+        self.requests = []
+        self.table = []
+        # Queries over more than sample_days days are reported as sampled.
+        self.sample_days = sample_days
+
+        for day in range(days):
+            for i, source in enumerate(['google', 'bing']):
+                self.table.append({
+                    'ga:date': (datetime.date(2012, 1, 1) +
+                        datetime.timedelta(days=day)).strftime('%Y%m%d'),
+                    'ga:source': source,
+                    'ga:visits': 10 * day + i + 1,
+                    'ga:bounces': day + i,
+                    'ga:pageviews': 20 * day + i,
+                })
+
+
+    def query (self, params):
+        start = params['start-date'].replace('-', '')
+        end = params['end-date'].replace('-', '')
+        dimensions = params.get('dimensions', '').split(',') if params.get('dimensions') else []
+        metrics = params['metrics'].split(',')
+
+        groups = {}
+        for row in self.table:
+            if start <= row['ga:date'] <= end:
+                key = tuple(row[d] for d in dimensions)
+                acc = groups.setdefault(key, [0] * len(metrics))
+                for i, m in enumerate(metrics):
+                    acc[i] += row[m]
+
+        rows = [list(k) + [str(v) for v in vs] for k, vs in sorted(groups.items())]
+
+        for s in reversed(params.get('sort', '').split(',') if params.get('sort') else []):
+            i = (dimensions + metrics).index(s.lstrip('-'))
+            numeric = s.lstrip('-') in metrics
+            rows.sort(key=lambda r: int(r[i]) if numeric else r[i], reverse=s.startswith('-'))
+
+        headers = [{'name': c, 'dataType': self.DATATYPES.get(c, 'INTEGER')}
+            for c in dimensions + metrics]
+
+        return headers, rows
+
+
+    def sampled (self, params):
+        if self.sample_days is None:
+            return False
+
+        days = (gc.parse_date(params['end-date']) -
+            gc.parse_date(params['start-date'])).days + 1
+        return days > self.sample_days
+
+
+    def get (self, url, **kwargs):
+        from gaclient import PY3
+        if PY3:
+            from urllib.parse import urlparse, parse_qsl
+        else:
+            from urlparse import urlparse, parse_qsl
+
+        params = dict(parse_qsl(urlparse(url).query))
+        self.requests.append(params)
+
+        headers, rows = self.query(params)
+        start = int(params.get('start-index', 1))
+        size = int(params.get('max-results', 10000))
+        data = {
+            'kind': 'analytics#gaData',
+            'totalResults': len(rows),
+            'columnHeaders': headers,
+            'containsSampledData': self.sampled(params),
+            'rows': rows[start - 1:start - 1 + size],
+        }
+        if start - 1 + size < len(rows):
+            data['nextLink'] = url
+
+        if 'totalsForAllResults' in params.get('fields', 'totalsForAllResults'):
+            totals = [sum(int(r[i]) for r in rows) for i in range(len(headers))
+                if headers[i]['dataType'] == 'INTEGER']
+            data['totalsForAllResults'] = dict(
+                (h['name'], str(t)) for h, t in zip(headers[-len(totals):], totals))
+
+        if 'fields' in params:
+            data = dict((k, v) for k, v in data.items()
+                if k in params['fields'].split(','))
+
+        return MockResponse(data)
+
+
+
+class TestQueryCache (object):
+
+    def test_projects_metrics_and_slices_dates (self):
+        session = FakeAnalytics()
+        cache = gc.QueryCache(session)
+
+        full = cache.fetch('1', '2012-01-01', '2012-01-10', ['visits', 'bounces'], ['date'])
+        eq_(10, len(full))
+        eq_(1, len(session.requests))
+
+        part = cache.fetch('1', '2012-01-03', '2012-01-04', ['visits'], ['date'])
+        eq_(1, len(session.requests))
+        eq_([{'date': datetime.date(2012, 1, 3), 'visits': 43},
+            {'date': datetime.date(2012, 1, 4), 'visits': 63}], part)
+
+
+    def test_no_date_slicing_without_date_dimension (self):
+        session = FakeAnalytics()
+        cache = gc.QueryCache(session)
+
+        cache.fetch('1', '2012-01-01', '2012-01-10', ['visits'], ['source'])
+        cache.fetch('1', '2012-01-01', '2012-01-05', ['visits'], ['source'])
+        eq_(2, len(session.requests))
+
+
+    def test_fetch_many_plans_covering_queries (self):
+        session = FakeAnalytics()
+        cache = gc.QueryCache(session)
+
+        results = cache.fetch_many([
+            dict(profile_id='1', start_date='2012-01-01', end_date='2012-01-04',
+                metrics=['visits'], dimensions=['date']),
+            dict(profile_id='1', start_date='2012-01-05', end_date='2012-01-08',
+                metrics=['bounces'], dimensions=['date']),
+            dict(profile_id='1', start_date='2012-01-01', end_date='2012-01-08',
+                metrics=['visits'], dimensions=['source']),
+        ])
+
+        eq_(2, len(session.requests))
+        eq_([4, 4, 2], [len(r) for r in results])
+        eq_(set(['date', 'bounces']), set(results[1][0]))
+
+
+    def test_sampled_results_are_not_sliced (self):
+        session = FakeAnalytics(sample_days=5)
+        cache = gc.QueryCache(session)
+
+        full = cache.fetch('1', '2012-01-01', '2012-01-10', ['visits'], ['date'])
+        ok_(full.sampled)
+
+        part = cache.fetch('1', '2012-01-03', '2012-01-04', ['visits'], ['date'])
+        eq_(2, len(session.requests))
+        ok_(not part.sampled)
+        eq_(2, len(part))
+
+        ok_(cache.fetch('1', '2012-01-01', '2012-01-10', ['visits'], ['date']).sampled)
+        eq_(2, len(session.requests))
+
+
+    def test_no_date_merging_after_sampling (self):
+        session = FakeAnalytics(sample_days=5)
+        cache = gc.QueryCache(session)
+        cache.fetch('1', '2012-01-01', '2012-01-10', ['visits'], ['date'])
+
+        results = cache.fetch_many([
+            dict(profile_id='1', start_date='2012-01-01', end_date='2012-01-04',
+                metrics=['visits'], dimensions=['date']),
+            dict(profile_id='1', start_date='2012-01-05', end_date='2012-01-08',
+                metrics=['visits'], dimensions=['date']),
+        ])
+
+        eq_(3, len(session.requests))
+        eq_([False, False], [r.sampled for r in results])
+
+
+    def test_projection_drops_zero_rows (self):
+        session = FakeAnalytics(days=2)
+        cache = gc.QueryCache(session)
+
+        cache.fetch('1', '2012-01-01', '2012-01-02', ['visits', 'bounces'],
+            ['date', 'source'])
+        rows = cache.fetch('1', '2012-01-01', '2012-01-02', ['bounces'],
+            ['date', 'source'])
+
+        # google has no bounces on the first day.
+        eq_(3, len(rows))
+        eq_(1, len(session.requests))
+
+
+    def test_plan_respects_metrics_limit (self):
+        specs = [gc._query_spec(gc.build_data_query('1', '2012-01-01', '2012-01-02',
+                ['m{}'.format(i) for i in range(8)], ['date'])),
+            gc._query_spec(gc.build_data_query('1', '2012-01-02', '2012-01-03',
+                ['x{}'.format(i) for i in range(4)], ['date']))]
+
+        eq_(2, len(gc.plan_covering_queries(specs)))
+        eq_(1, len(gc.plan_covering_queries(specs[:1] * 2)))
+
+
+class TestFetchWide (object):
+
+    def test_joins_metric_groups (self):
+        session = FakeAnalytics(days=3)
+        metrics = ['visits'] * 10 + ['bounces', 'pageviews']
+
+        rows = list(gc.fetch_wide(session, '1', '2012-01-01', '2012-01-03',
+            metrics, ['date', 'source'], ordered=True))
+
+        eq_(2, len(session.requests))
+        eq_(6, len(rows))
+        eq_({'date': datetime.date(2012, 1, 1), 'source': 'bing',
+            'visits': 2, 'bounces': 1, 'pageviews': 1}, rows[0])
+
+
+    def test_sampled_groups (self):
+        session = FakeAnalytics(days=3)
+        session.sampled = lambda params: 'ga:bounces' in params['metrics']
+
+        rows = gc.fetch_wide(session, '1', '2012-01-01', '2012-01-03',
+            ['visits'] * 10 + ['bounces'], ['date', 'source'])
+        eq_([None, None], rows.sampled_groups)
+
+        eq_(6, len(list(rows)))
+        eq_([False, True], rows.sampled_groups)
+        ok_(rows.sampled)
+
+
+    @raises(AssertionError)
+    def test_sort_is_rejected (self):
+        gc.fetch_wide(FakeAnalytics(days=3), '1', '2012-01-01', '2012-01-03',
+            ['visits'] * 10 + ['bounces'], ['date'], sort=['-visits'])
+
+
+    def test_split_metrics (self):
+        eq_([[1, 2], [3]], gc.split_metrics([1, 2, 3], 2))
+        eq_(3, len(gc.split_metrics(list(range(25)))))
+
+
+    @raises(AssertionError)
+    def test_too_many_metrics_for_single_query (self):
+        gc.build_data_query('1', '2012-01-01', '2012-01-01', ['visits'] * 11)
+
+
+class TestRollup (object):
+
+    def build (self):
+        return gc.Rollup(['source'], {
+            'visits': 'sum',
+            'bounce_rate': ('ratio', 'bounces', 'visits'),
+            'mean_visits': ('mean', 'visits'),
+            'days': ('count',),
+            'best_day': ('max', 'visits'),
+        })
+
+
+    def test_feed_cursor (self):
+        rollup = self.build()
+        rollup.feed(gc.Cursor(FakeAnalytics(days=2), '1', '2012-01-01',
+            '2012-01-02', ['visits', 'bounces'], ['date', 'source'], max_results=3))
+
+        rows = sorted(rollup.results(), key=lambda r: r['source'])
+        eq_({'source': 'bing', 'visits': 14, 'bounce_rate': 3.0 / 14,
+            'mean_visits': 7.0, 'days': 2, 'best_day': 12}, rows[0])
+        eq_(12, rows[1]['visits'])
+
+
+    def test_merge_partial_aggregates (self):
+        a, b = self.build(), self.build()
+        a.update({'source': ['x', 'y'], 'visits': [1, 2], 'bounces': [0, 1]})
+        b.update({'source': ['y', 'z'], 'visits': [3, 4], 'bounces': [1, 0]})
+        a.merge(b)
+
+        rows = dict((r['source'], r) for r in a.results())
+        eq_(3, len(a))
+        eq_(5, rows['y']['visits'])
+        eq_(2, rows['y']['days'])
+        eq_(3, rows['y']['best_day'])
+        eq_(0.4, rows['y']['bounce_rate'])
+
+
+    def test_group_by_function (self):
+        rollup = gc.Rollup([('month', 'date', lambda d: d.month)], {'visits': 'sum'})
+        rollup.update({'date': [datetime.date(2012, 1, 1), datetime.date(2012, 1, 2),
+            datetime.date(2012, 2, 1)], 'visits': [1, 2, 3]})
+
+        eq_([{'month': 1, 'visits': 3}, {'month': 2, 'visits': 3}], rollup.results())
+
+
+
+def test_cursor_columns ():
+    cursor = gc.Cursor(FakeAnalytics(days=2), '1', '2012-01-01', '2012-01-02',
+        ['visits'], ['date'])
+
+    eq_({'date': [datetime.date(2012, 1, 1), datetime.date(2012, 1, 2)],
+        'visits': [3, 23]}, dict(cursor.columns()))
+    list(cursor)
+    eq_([3, 23], cursor.columns()['visits'])
+
+
+
+class TestParsePool (object):
+
+    def test_cursor_with_process_pool (self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(2) as pool:
+            cursor = gc.Cursor(FakeAnalytics(days=3), '1', '2012-01-01', '2012-01-03',
+                ['visits'], ['date', 'source'], max_results=4, parse_pool=pool)
+            rows = list(gc.ResponseIterator(cursor))
+
+        eq_(6, len(rows))
+        eq_({'date': datetime.date(2012, 1, 1), 'source': 'bing', 'visits': 2}, rows[0])
+
+
+    def test_parse_page_error (self):
+        body = json.dumps({'error': {'code': 500, 'message': 'm', 'errors': []}})
+
+        try:
+            gc.parse_page(body)
+
+        except gc.AnalyticsError as ex:
+            ex = pickle.loads(pickle.dumps(ex))
+            eq_(500, ex.code)
+            eq_([], ex.errors)
+
+        else:
+            ok_(False)
+
+
+
+class TestPartialResponse (object):
+
+    def test_later_pages_omit_headers (self):
+        session = FakeAnalytics(days=3)
+        cursor = gc.Cursor(session, '1', '2012-01-01', '2012-01-03',
+            ['visits'], ['date', 'source'], max_results=4)
+        rows = list(gc.ResponseIterator(cursor))
+
+        eq_(6, len(rows))
+        ok_('columnHeaders' in session.requests[0]['fields'])
+        ok_('columnHeaders' not in session.requests[1]['fields'])
+        eq_(datetime.date(2012, 1, 3), rows[-1]['date'])
+
+
+    def test_totals (self):
+        fields = gc.PAGE_FIELDS + ['totalsForAllResults']
+        cursor = gc.Cursor(FakeAnalytics(days=2), '1', '2012-01-01', '2012-01-02',
+            ['visits'], ['date'], fields=fields)
+
+        eq_(None, gc.Cursor(FakeAnalytics(), '1', '2012-01-01', '2012-01-02',
+            ['visits']).totals)
+        eq_(2, len(cursor))
+        eq_({'visits': 26}, cursor.totals)
+
+
+class TestLazyRows (object):
+
+    def test_converts_on_access (self):
+        calls = []
+        schema = gc._RowSchema([('a', lambda v: calls.append(v) or int(v)), ('b', str)])
+        row = gc.LazyRow(['1', 'x'], schema)
+
+        eq_(1, row['a'])
+        eq_(1, row['a'])
+        eq_(['1'], calls)
+        eq_({'a': 1, 'b': 'x'}, dict(row))
+        eq_(row, {'a': 1, 'b': 'x'})
+        assert_raises(KeyError, lambda: row['c'])
+        eq_(None, row.get('c'))
+
+
+    def test_cursor_lazy_rows (self):
+        cursor = gc.Cursor(FakeAnalytics(days=3), '1', '2012-01-01', '2012-01-03',
+            ['visits'], ['date', 'source'], max_results=4, lazy_rows=True)
+        rows = list(gc.ResponseIterator(cursor))
+
+        ok_(all(isinstance(r, gc.LazyRow) for r in rows))
+        eq_([r for r in rows if r['source'] == 'google'][-1],
+            {'date': datetime.date(2012, 1, 3), 'source': 'google', 'visits': 21})
+
+
+    def test_parse_ga_date (self):
+        eq_(datetime.date(2012, 1, 31), gc._parse_ga_date('20120131'))
+        eq_(datetime.date(2012, 1, 31), gc._parse_ga_date('2012-01-31'))
+        assert_raises(ValueError, gc._parse_ga_date, '20121331')
+
+
+class TestIntern (object):
+
+    def test_shared_instances_and_lru (self):
+        table = gc.InternTable(maxsize=2)
+        a = ''.join(['go', 'ogle'])
+        b = ''.join(['goo', 'gle'])
+
+        ok_(table(a) is table(b))
+        table('bing')
+        table('google')
+        table('yahoo')
+
+        eq_(2, len(table))
+        ok_(table(b) is a)
+
+
+    def test_cursor_interns_strings_across_pages (self):
+        cursor = gc.Cursor(FakeAnalytics(days=3), '1', '2012-01-01', '2012-01-03',
+            ['visits'], ['date', 'source'], max_results=2, intern=True)
+        rows = list(gc.ResponseIterator(cursor))
+
+        google = [r['source'] for r in rows if r['source'] == 'google']
+        eq_(3, len(google))
+        ok_(all(s is google[0] for s in google))
+        eq_(2, len(cursor.intern.table('source')))
+
+
+CATALOG = {
+    'kind': 'analytics#columns',
+    'etag': '"abc"',
+    'items': [
+        {'id': 'ga:date', 'attributes': {'type': 'DIMENSION', 'dataType': 'STRING'}},
+        {'id': 'ga:source', 'attributes': {'type': 'DIMENSION', 'dataType': 'STRING'}},
+        {'id': 'ga:visits', 'attributes': {'type': 'METRIC', 'dataType': 'INTEGER'}},
+        {'id': 'ga:bounces', 'attributes': {'type': 'METRIC', 'dataType': 'INTEGER'}},
+        {'id': 'ga:goalXXCompletions', 'attributes': {'type': 'METRIC',
+            'dataType': 'INTEGER', 'minTemplateIndex': '1', 'maxTemplateIndex': '20'}},
+    ],
+}
+
+
+class TestMetadataCatalog (object):
+
+    def write (self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(CATALOG, fp)
+
+        return path
+
+
+    def query (self, *args, **kwargs):
+        kwargs['catalog'] = self.catalog
+        return gc.build_data_query('1', '2012-01-01', '2012-01-02', *args, **kwargs)
+
+
+    @property
+    def catalog (self):
+        path = self.write()
+        try:
+            return gc.MetadataCatalog(path)
+        finally:
+            os.remove(path)
+
+
+    def test_valid_queries (self):
+        self.query(['visits', 'goal20Completions'], ['date'], ['-visits'], ['ga:source==a'])
+
+        catalog = self.catalog
+        eq_('INTEGER', catalog.column('goal3Completions')['dataType'])
+        eq_(None, catalog.column('goal21Completions'))
+
+
+    def test_invalid_queries (self):
+        assert_raises(gc.InvalidQuery, self.query, ['vists'])
+        assert_raises(gc.InvalidQuery, self.query, ['visits'], ['bounces'])
+        assert_raises(gc.InvalidQuery, self.query, ['date'])
+        assert_raises(gc.InvalidQuery, self.query, ['visits', 'visits'])
+        assert_raises(gc.InvalidQuery, self.query, ['visits'], sort=['bounces'])
+        assert_raises(gc.InvalidQuery, self.query, ['visits'], filters=['ga:foo==1'])
+
+
+    def test_cursor_without_header_fields (self):
+        session = FakeAnalytics(days=2)
+        cursor = gc.Cursor(session, '1', '2012-01-01', '2012-01-02',
+            ['visits'], ['date'], catalog=self.catalog)
+
+        eq_([{'date': datetime.date(2012, 1, 1), 'visits': 3},
+            {'date': datetime.date(2012, 1, 2), 'visits': 23}], list(cursor))
+        ok_('columnHeaders' not in session.requests[0]['fields'])
+
+
+    def test_refresh_with_etag (self):
+        class Response (object):
+            status_code = 304
+
+        class Session (object):
+            def get (self, url, headers):
+                self.headers = headers
+                return Response()
+
+        session = Session()
+        path = self.write()
+
+        try:
+            catalog = gc.MetadataCatalog(path)
+            ok_(catalog.stale)
+            catalog.refresh(session)
+
+            eq_('"abc"', session.headers['If-None-Match'])
+            ok_(not catalog.stale)
+            ok_(not gc.MetadataCatalog(path).stale)
+            eq_(5, len(gc.MetadataCatalog(path)))
+
+        finally:
+            os.remove(path)
+
+
+class FakeManagement (object):
+
+    def __init__ (self):
+        self.requests = []
+        self.updated = '2014-01-01'
+
+
+    def get (self, url, **kwargs):
+        path = url.split('/management', 1)[1].split('?')[0]
+        self.requests.append(path)
+        parts = path.strip('/').split('/')
+
+        if parts == ['accounts']:
+            items = [{'id': a, 'updated': self.updated} for a in ('1', '2')]
+        elif parts[-1] == 'webproperties':
+            items = [{'id': 'UA-{}-{}'.format(parts[1], i), 'accountId': parts[1],
+                'updated': '2014-01-01'} for i in (1, 2)]
+        else:
+            items = [{'id': '{}{}'.format(parts[3], i)} for i in (1, 2)]
+
+        data = {'items': items}
+        if parts[-1] == 'profiles' and 'start-index' not in url:
+            data = {'items': items[:1], 'nextLink': url + '&start-index=2'}
+        elif parts[-1] == 'profiles':
+            data = {'items': items[1:]}
+
+        return MockResponse(data)
+
+
+
+class TestProfileDirectory (object):
+
+    def test_crawls_and_caches (self):
+        session = FakeManagement()
+        directory = gc.ProfileDirectory(session)
+
+        ids = directory.profile_ids()
+        eq_(8, len(ids))
+        eq_(['UA-1-11', 'UA-1-12'], ids[:2])
+        eq_(1 + 2 + 4 * 2, len(session.requests))
+
+        directory.profile_ids()
+        eq_(11, len(session.requests))
+
+        eq_(8, len(directory.cursors('2012-01-01', '2012-01-02', ['visits'])))
+
+
+    def test_incremental_refresh (self):
+        session = FakeManagement()
+        directory = gc.ProfileDirectory(session)
+        directory.profiles()
+
+        session.updated = '2014-02-01'
+        directory.profiles()
+        eq_(11, len(session.requests))
+
+        directory.profiles(refresh=True)
+        eq_(11 + 1 + 2, len(session.requests))
+
+        directory.ttl = 0
+        directory.profiles()
+        eq_(14 + 11, len(session.requests))
+
+
+    def test_retries_rate_limit_errors (self):
+        gc.time.sleep, sleep = (lambda s: None), gc.time.sleep
+
+        class Flaky (FakeManagement):
+            failures = 3
+
+            def get (self, url, **kwargs):
+                if '/profiles' in url and self.failures:
+                    self.failures -= 1
+                    return MockResponse({'error': {'code': 403, 'message': 'm',
+                        'errors': [{'reason': 'userRateLimitExceeded'}]}})
+
+                return FakeManagement.get(self, url, **kwargs)
+
+        try:
+            eq_(8, len(gc.ProfileDirectory(Flaky()).profile_ids()))
+
+            session = Flaky()
+            session.failures = 10
+            assert_raises(gc.AnalyticsError,
+                gc.ProfileDirectory(session, attempts=2).profile_ids)
+
+        finally:
+            gc.time.sleep = sleep
+
+
+class FakeBatch (FakeAnalytics):
+    ''' Serves batch requests, the first `failures` parts fail once. '''
+
+    def __init__ (self, failures=0, **kwargs):
+        FakeAnalytics.__init__(self, **kwargs)
+        self.batches = []
+        self.failures = failures
+
+
+    def post (self, url, data, headers):
+        boundary = headers['Content-Type'].split('boundary=')[1]
+        requests = [p for p in data.decode('utf-8').split('--' + boundary)
+            if 'GET ' in p]
+        self.batches.append(len(requests))
+
+        out = []
+        for part in requests:
+            content_id = part.split('Content-ID: <')[1].split('>')[0]
+            path = part.split('GET ')[1].split()[0]
+
+            if self.failures:
+                self.failures -= 1
+                status, body = '503 Service Unavailable', json.dumps({'error': {
+                    'code': 503, 'message': 'm', 'errors': [{'reason': 'backendError'}]}})
+            else:
+                status = '200 OK'
+                body = json.dumps(self.get('https://www.googleapis.com' + path).data)
+
+            out.append('--resp\r\nContent-Type: application/http\r\n'
+                'Content-ID: <response-{}>\r\n\r\nHTTP/1.1 {}\r\n'
+                'Content-Type: application/json\r\n\r\n{}\r\n'.format(content_id, status, body))
+
+        return MockSession(None, content=(''.join(out) + '--resp--').encode('utf-8'),
+            headers={'Content-Type': 'multipart/mixed; boundary=resp'})
+
+
+
+class TestBatchTransport (object):
+
+    def cursors (self, session, n, **kwargs):
+        return [gc.Cursor(session, str(i), '2012-01-01', '2012-01-03',
+            ['visits'], ['date'], **kwargs) for i in range(n)]
+
+
+    def test_fetch_all_multiplexes_pages (self):
+        session = FakeBatch(days=3)
+        results = gc.BatchTransport(session, batch_size=2).fetch_all(
+            self.cursors(session, 3, max_results=2))
+
+        eq_([3, 3, 3], [len(r) for r in results])
+        eq_(datetime.date(2012, 1, 3), results[2][2]['date'])
+        eq_([2, 1, 2, 1], session.batches)
+
+
+    def test_retries_failed_parts (self):
+        gc.random.random, random = (lambda: 0), gc.random.random
+        gc.time.sleep, sleep = (lambda s: None), gc.time.sleep
+
+        try:
+            session = FakeBatch(failures=1, days=3)
+            cursors = self.cursors(session, 2)
+            eq_([], gc.BatchTransport(session).execute(cursors))
+            eq_([2, 1], session.batches)
+            eq_([3, 3], [len(c) for c in cursors])
+
+        finally:
+            gc.random.random, gc.time.sleep = random, sleep
+
+
+    def test_reports_permanent_failures (self):
+        gc.time.sleep, sleep = (lambda s: None), gc.time.sleep
+
+        try:
+            session = FakeBatch(failures=10, days=3)
+            cursors = self.cursors(session, 2)
+            failures = gc.BatchTransport(session, attempts=2).execute(cursors)
+
+            eq_(2, len(failures))
+            eq_(503, failures[0][1].code)
+            eq_(None, cursors[0]._len)
+
+        finally:
+            gc.time.sleep = sleep
+
+
+def test_stdlib_json_decoder ():
+    eq_({'a': u'\xe9'}, gc._json_loads(u'{"a": "\xe9"}'.encode('utf-8')))
+    eq_({'a': 1}, gc._json_loads('{"a": 1}'))
+    assert_raises(ValueError, gc._json_loads, b'{"a": "\xff"}')
+
+
+def test_is_retryable ():
+    ok_(gc._is_retryable(gc.AnalyticsError(500, 'm', [])))
+    ok_(gc._is_retryable(gc.AnalyticsError(403, 'm', [{'reason': 'userRateLimitExceeded'}])))
+    ok_(not gc._is_retryable(gc.AnalyticsError(400, 'm', [{'reason': 'invalidParameter'}])))
+    ok_(gc._is_retryable(ValueError()))
+    ok_(not gc._is_retryable(KeyError()))
+
+
+class TestHedgePolicy (object):
+
+    def policy (self, **kwargs):
+        policy = gc.HedgePolicy(min_samples=5, **kwargs)
+        for i in range(20):
+            policy.requests += 1
+            policy.observe(0.01)
+
+        return policy
+
+
+    def test_duplicates_slow_request (self):
+        calls = []
+        release = threading.Event()
+
+        def request (value):
+            calls.append(value)
+            if len(calls) == 1:
+                release.wait(10)
+                return 'slow'
+            return 'fast'
+
+        policy = self.policy()
+
+        try:
+            eq_('fast', policy.call(request, 'x'))
+        finally:
+            release.set()
+
+        eq_(['x', 'x'], calls)
+        eq_(1, policy.hedges)
+
+
+    def test_budget_limits_hedges (self):
+        def request ():
+            time.sleep(0.05)
+            return 'ok'
+
+        policy = self.policy(budget=0)
+        eq_('ok', policy.call(request))
+        eq_(0, policy.hedges)
+        eq_(None, gc.HedgePolicy().delay())
+
+
+    def test_concurrent_requests_are_not_limited (self):
+        lock = threading.Lock()
+        running = []
+        everyone = threading.Event()
+
+        def request ():
+            with lock:
+                running.append(1)
+                if len(running) == 16:
+                    everyone.set()
+
+            # Blocks until all requests run at once, which fails if they
+            # are queued behind the two workers for duplicates.
+            everyone.wait(10)
+            return 'ok'
+
+        # Requests are hedged after 60 seconds, so all of them run in
+        # threads of their own without being duplicated.
+        policy = gc.HedgePolicy(min_samples=5, budget=1, max_workers=2)
+        for i in range(20):
+            policy.requests += 1
+            policy.observe(60)
+
+        with gc.ThreadPoolExecutor(16) as pool:
+            futures = [pool.submit(policy.call, request) for _ in range(16)]
+            eq_(['ok'] * 16, [f.result() for f in futures])
+
+        ok_(everyone.is_set())
+        eq_(16, len(running))
+        eq_(0, policy.hedges)
+
+
+    def test_cursor_with_hedge (self):
+        policy = self.policy()
+        cursor = gc.Cursor(FakeAnalytics(days=2), '1', '2012-01-01', '2012-01-02',
+            ['visits'], ['date'], hedge=policy)
+
+        eq_(2, len(list(cursor)))
+        eq_(21, policy.requests)
+
+
+class TestPageSizer (object):
+
+    def test_adapts_to_speed_and_errors (self):
+        sizer = gc.PageSizer(target_latency=1, initial=1000)
+        sizer.observe(1000, 0.1, 10000)
+        eq_(2000, sizer.size)
+
+        sizer.observe(2000, 2.0)
+        eq_(7300, sizer.rows_per_second)
+        eq_(4000, sizer.size)
+
+        sizer.observe(error=True)
+        eq_(2000, sizer.size)
+
+        sizer.observe(10, 1.0)
+        eq_(2000, sizer.size)
+
+
+    def test_limits (self):
+        sizer = gc.PageSizer(max_bytes=100000, initial=1000)
+        sizer.observe(1000, 0.01, 1000000)
+        eq_(100, sizer.size)
+
+        sizer = gc.PageSizer(initial=5000)
+        sizer.observe(5000, 0.01)
+        eq_(10000, sizer.size)
+
+
+    def test_cursor_pages_grow (self):
+        session = FakeAnalytics(days=10)
+        sizer = gc.PageSizer(min_results=1, initial=2)
+        cursor = gc.Cursor(session, '1', '2012-01-01', '2012-01-10',
+            ['visits'], ['date', 'source'], page_sizer=sizer)
+
+        eq_(20, len(list(gc.ResponseIterator(cursor))))
+        eq_(['2', '4', '8', '16'], [r['max-results'] for r in session.requests])
+        eq_(['1', '3', '7', '15'], [r['start-index'] for r in session.requests])
+
+
+    def test_rate_limits_keep_page_size (self):
+        gc.time.sleep, sleep = (lambda s: None), gc.time.sleep
+
+        class Throttled (FakeAnalytics):
+            errors = [(403, 'userRateLimitExceeded'), (403, 'quotaExceeded'),
+                (503, 'backendError')]
+
+            def get (self, url, **kwargs):
+                if self.errors:
+                    code, reason = self.errors.pop(0)
+                    return MockResponse({'error': {'code': code, 'message': 'm',
+                        'errors': [{'reason': reason}]}})
+
+                return FakeAnalytics.get(self, url, **kwargs)
+
+        try:
+            sizer = gc.PageSizer()
+            cursor = gc.Cursor(Throttled(days=2), '1', '2012-01-01',
+                '2012-01-02', ['visits'], ['date'], page_sizer=sizer)
+
+            eq_(2, len(list(cursor)))
+            eq_(5000, sizer.size)
+            eq_('5000', cursor.session.requests[0]['max-results'])
+
+        finally:
+            gc.time.sleep = sleep
+
+
+class TestResponseIterator (object):
+
+    def cursor (self, session, **kwargs):
+        return gc.Cursor(session, '1', '2012-01-01', '2012-01-10',
+            ['visits'], ['date', 'source'], **kwargs)
+
+
+    def test_limit_is_pushed_down (self):
+        session = FakeAnalytics(days=10)
+        rows = list(gc.ResponseIterator(self.cursor(session), limit=3))
+
+        eq_(3, len(rows))
+        eq_([('1', '3')], [(r['start-index'], r['max-results']) for r in session.requests])
+
+
+    def test_limit_does_not_stick_to_cursor (self):
+        session = FakeAnalytics(days=10)
+        cursor = self.cursor(session)
+
+        eq_(3, len(list(gc.ResponseIterator(cursor, limit=3))))
+        eq_(20, len(list(gc.ResponseIterator(cursor))))
+        eq_([('1', '3'), ('4', '10000')],
+            [(r['start-index'], r['max-results']) for r in session.requests])
+
+
+    def test_limit_across_pages (self):
+        session = FakeAnalytics(days=10)
+        rows = list(gc.ResponseIterator(self.cursor(session, max_results=4), limit=10))
+
+        eq_(10, len(rows))
+        eq_([('1', '4'), ('5', '4'), ('9', '2')],
+            [(r['start-index'], r['max-results']) for r in session.requests])
+
+
+    def test_prefetch (self):
+        session = FakeAnalytics(days=10)
+        it = gc.ResponseIterator(self.cursor(session, max_results=6), prefetch=True)
+
+        eq_(20, len(list(it)))
+        eq_(4, len(session.requests))
+
+
+    def test_close_stops_iteration (self):
+        session = FakeAnalytics(days=10)
+
+        with gc.ResponseIterator(self.cursor(session, max_results=6), prefetch=True) as it:
+            rows = iter(it)
+            next(rows)
+
+        eq_([], list(rows))
+        eq_(None, it.cursor)
+        ok_(len(session.requests) <= 2)
+
+
+def test_import_is_lazy ():
+    output = subprocess.check_output([sys.executable, '-c',
+        'import sys, gaclient; gaclient.build_data_query("1", "2012-01-01", '
+        '"2012-01-02", ["visits"]); print(" ".join(sorted(sys.modules)))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    modules = output.decode().split()
+    for name in ('requests', 'requests_oauthlib', 'ssl', 'numpy'):
+        ok_(name not in modules, name)
+
+
+def test_shard_dates ():
+    eq_([(datetime.date(2014, 1, 30), datetime.date(2014, 1, 31)),
+         (datetime.date(2014, 2, 1), datetime.date(2014, 2, 28)),
+         (datetime.date(2014, 3, 1), datetime.date(2014, 3, 2))],
+        gc.shard_dates('2014-01-30', '2014-03-02', 'month'))
+
+    # 2014-01-01 is a wednesday.
+    eq_([(datetime.date(2014, 1, 1), datetime.date(2014, 1, 5)),
+         (datetime.date(2014, 1, 6), datetime.date(2014, 1, 8))],
+        gc.shard_dates('2014-01-01', '2014-01-08', 'week'))
+
+    eq_(3, len(gc.shard_dates('2014-01-01', '2014-01-03', 'day')))
+    assert_raises(ValueError, gc.shard_dates, '2014-01-01', '2014-01-03', 'year')
+
+
+def test_rate_limiter ():
+    limiter = gc.RateLimiter(100, burst=2)
+
+    eq_(0, limiter.acquire())
+    eq_(0, limiter.acquire())
+    ok_(limiter.acquire() > 0)
+
+
+class TestMain (object):
+
+    def run (self, queries, *args, **extra):
+        session = FakeAnalytics(days=10)
+        directory = tempfile.mkdtemp()
+        job = os.path.join(directory, 'job.json')
+
+        with open(job, 'w') as fp:
+            json.dump(dict(extra, client_id='id', client_secret='secret',
+                token={'refresh_token': 'token'}, queries=queries), fp)
+
+        build_session, stderr = gc.build_session, sys.stderr
+        gc.build_session = lambda *args: session
+        sys.stderr = self.stderr = io.StringIO()
+        try:
+            status = gc.main([job, '-q', '-o', directory] + list(args))
+        finally:
+            gc.build_session, sys.stderr = build_session, stderr
+
+        return status, session, directory
+
+
+    def test_query_arguments (self):
+        status, session, directory = self.run([{'name': 'visits',
+            'profile_id': '1', 'start_date': '2012-01-01',
+            'end_date': '2012-01-10', 'metrics': ['visits'],
+            'dimensions': ['date', 'source'], 'max_results': 8}])
+
+        eq_(0, status)
+        eq_(['8', '8', '8'], [r['max-results'] for r in session.requests])
+
+        assert_raises(SystemExit, self.run, [{'name': 'visits',
+            'profile_id': '1', 'start_date': '2012-01-01',
+            'end_date': '2012-01-10', 'metrics': ['visits'], 'max_result': 8}])
+
+
+    def test_multiple_profiles (self):
+        status, session, directory = self.run([
+            {'name': 'visits', 'start_date': '2012-01-01',
+             'end_date': '2012-01-02', 'metrics': ['visits']},
+            {'name': 'other', 'profile_ids': ['3'], 'start_date': '2012-01-01',
+             'end_date': '2012-01-01', 'metrics': ['visits']}],
+            '-s', 'day', profiles=['1', '2'])
+
+        eq_(0, status)
+        eq_(5, len(session.requests))
+
+        with open(os.path.join(directory, 'visits.jsonl')) as fp:
+            rows = [json.loads(line) for line in fp]
+
+        eq_(4, len(rows))
+        eq_(set(['1', '2']), set(r['profile_id'] for r in rows))
+        eq_(['visits 1: ok, 2 rows', 'visits 2: ok, 2 rows', 'other 3: ok, 1 rows'],
+            self.stderr.getvalue().splitlines())
+
+
+    def test_export_sharded_csv (self):
+        status, session, directory = self.run([{'name': 'visits',
+            'profile_id': '1', 'start_date': '2012-01-01',
+            'end_date': '2012-01-10', 'metrics': ['visits'],
+            'dimensions': ['date', 'source']}], '-f', 'csv', '-s', 'week',
+            '-c', '2')
+
+        eq_(0, status)
+        # 2012-01-01 is a sunday.
+        eq_(3, len(session.requests))
+
+        with open(os.path.join(directory, 'visits.csv')) as fp:
+            lines = fp.read().splitlines()
+
+        eq_('date,source,visits', lines[0])
+        eq_(21, len(lines))
+        ok_('2012-01-01,bing,2' in lines)
+
+
+    def test_failed_query_sets_exit_status (self):
+        status, session, directory = self.run([
+            {'name': 'ok', 'profile_id': '1', 'start_date': '2012-01-01',
+             'end_date': '2012-01-02', 'metrics': ['visits']},
+            {'name': 'broken', 'profile_id': '1', 'start_date': '2012-01-02',
+             'end_date': '2012-01-01', 'metrics': ['visits']}])
+
+        eq_(1, status)
+
+        with open(os.path.join(directory, 'ok.jsonl')) as fp:
+            eq_([{'visits': 26}], [json.loads(line) for line in fp])
+
+        ok_(not os.path.exists(os.path.join(directory, 'broken.jsonl')))
+
+
+class TestMergeSorted (object):
+
+    def cursor (self, session, start, end, sort, **kwargs):
+        return gc.Cursor(session, '1', start, end, ['visits'],
+            ['date', 'source'], sort=sort, **kwargs)
+
+
+    def test_merges_shards (self):
+        session = FakeAnalytics(days=10)
+        sort = ['-visits', 'source']
+        shards = [self.cursor(session, start, end, sort, max_results=3)
+            for start, end in gc.shard_dates('2012-01-01', '2012-01-10', 'week')]
+
+        rows = list(gc.merge_sorted(shards))
+        expected = list(gc.ResponseIterator(
+            self.cursor(session, '2012-01-01', '2012-01-10', sort)))
+
+        eq_(20, len(rows))
+        eq_(expected, rows)
+
+
+    def test_descending_strings (self):
+        rows = list(gc.merge_sorted([[{'a': 'c'}, {'a': 'a'}], [{'a': 'b'}]],
+            sort=['-a']))
+
+        eq_(['c', 'b', 'a'], [r['a'] for r in rows])
+
+
+    def test_combines_equal_rows (self):
+        session = FakeAnalytics(days=2)
+        sources = [gc.Cursor(session, profile, '2012-01-01', '2012-01-02',
+            ['visits'], ['source'], sort=['source']) for profile in ('1', '2')]
+
+        eq_([{'source': 'bing', 'visits': 28}, {'source': 'google', 'visits': 24}],
+            list(gc.merge_sorted(sources, metrics=['visits'])))
+
+
+    def test_streams (self):
+        consumed = []
+
+        def source (name, count):
+            for i in range(count):
+                consumed.append(name)
+                yield {'n': i}
+
+        rows = gc.merge_sorted([source('a', 100), source('b', 100)], sort=['n'])
+
+        eq_({'n': 0}, next(rows))
+        ok_(len(consumed) <= 3)
+
+
+class TestRowBuffer (object):
+
+    def test_in_memory (self):
+        with gc.RowBuffer([{'a': 1}, {'a': 2}], max_rows=10) as rows:
+            ok_(not rows.spilled)
+            eq_(2, len(rows))
+            eq_({'a': 2}, rows[-1])
+            eq_([1, 2], [r['a'] for r in rows])
+
+
+    def test_spills_to_disk (self):
+        values = [None, True, False, -5, 2 ** 70, 1.5, u'caf\xe9', '',
+            datetime.date(2012, 1, 1)]
+        source = [dict((str(i), v) for i, v in enumerate(values[n:] + values[:n]))
+            for n in range(len(values))]
+
+        rows = gc.RowBuffer(source, max_rows=3)
+        ok_(rows.spilled)
+        eq_(len(source), len(rows))
+        eq_(source, list(rows))
+        eq_(source, list(rows))
+        eq_(source[4], rows[4])
+
+        rows.append(source[0])
+        eq_(source[0], rows[-1])
+
+        rows.close()
+        eq_(0, len(rows))
+        assert_raises(IndexError, rows.__getitem__, 0)
+
+
+    def test_cursor_results (self):
+        session = FakeAnalytics(days=10)
+        cursor = gc.Cursor(session, '1', '2012-01-01', '2012-01-10',
+            ['visits'], ['date', 'source'], max_results=6)
+
+        with gc.RowBuffer(gc.ResponseIterator(cursor), max_rows=5) as rows:
+            eq_(20, len(rows))
+            eq_({'date': datetime.date(2012, 1, 10), 'source': 'google',
+                'visits': 91}, rows[19])
+
+
+    def test_unsupported_value (self):
+        assert_raises(gc.UnsupportedDataType, gc.RowBuffer,
+            [{'a': object()}], max_rows=0)
+
+
+class TestWorkQueue (object):
+
+    def queue (self, **kwargs):
+        return gc.WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.db'), **kwargs)
+
+
+    def test_backfill (self):
+        queue = self.queue()
+        session = FakeAnalytics(days=10)
+        pages = {}
+
+        def sink (task, rows):
+            pages[task.id] = (task, rows)
+
+        eq_(6, queue.enqueue('visits', ['1', '2'], '2012-01-01', '2012-01-10',
+            ['visits'], ['date', 'source'], period='week', max_results=4))
+        eq_(0, queue.enqueue('visits', ['1', '2'], '2012-01-01', '2012-01-10',
+            ['visits'], ['date', 'source'], period='week', max_results=4))
+
+        # Shards of 1, 7 and 2 days take 1, 4 and 1 pages per profile.
+        eq_(12, gc.run_worker(queue, session, sink))
+        eq_({'done': 12}, queue.counts())
+        eq_(12, queue.used())
+        eq_(40, sum(len(rows) for _, rows in pages.values()))
+        eq_(set([1, 5, 9, 13]), set(task.start_index for task, _ in pages.values()))
+
+
+    def test_expired_lease_is_reclaimed (self):
+        queue = self.queue()
+        other = gc.WorkQueue(queue.path)
+        queue.add('visits', '1', '2012-01-01', '2012-01-01', {'metrics': ['visits']})
+
+        task = queue.claim(lease=-1)
+
+        reclaimed = other.claim()
+        eq_(task.id, reclaimed.id)
+        eq_(2, reclaimed.attempts)
+
+        ok_(not queue.complete(task))
+        ok_(other.complete(reclaimed))
+        eq_({'done': 1}, queue.counts())
+
+
+    def test_quota_budget (self):
+        queue = self.queue()
+        queue.set_budget(2)
+        queue.enqueue('visits', ['1', '2', '3'], '2012-01-01', '2012-01-01',
+            ['visits'])
+
+        eq_(2, gc.run_worker(queue, FakeAnalytics(days=1), lambda task, rows: None))
+        eq_({'done': 2, 'pending': 1}, queue.counts())
+        ok_(not queue.consume())
+
+
+    def test_failed_requests_are_retried_by_the_queue (self):
+        class Unavailable (FakeAnalytics):
+            def get (self, url, **kwargs):
+                self.requests.append(url)
+                return MockResponse({'error': {'code': 503, 'message': 'm',
+                    'errors': [{'reason': 'backendError'}]}})
+
+        session = Unavailable(days=1)
+        queue = self.queue(max_attempts=3, retry_delay=0)
+        queue.enqueue('visits', ['1'], '2012-01-01', '2012-01-01', ['visits'])
+
+        eq_(0, gc.run_worker(queue, session, lambda task, rows: None))
+        eq_(3, len(session.requests))
+        eq_(3, queue.used())
+        eq_({'failed': 1}, queue.counts())
+
+        # Failed tasks are delayed before they are claimed again.
+        queue = self.queue(max_attempts=3, retry_delay=60)
+        queue.enqueue('visits', ['1'], '2012-01-01', '2012-01-01', ['visits'])
+
+        eq_(0, gc.run_worker(queue, session, lambda task, rows: None))
+        eq_(4, len(session.requests))
+        eq_({'pending': 1}, queue.counts())
+        eq_(None, queue.claim())
+
+
+    def test_permanent_errors_are_not_retried (self):
+        class Invalid (FakeAnalytics):
+            def get (self, url, **kwargs):
+                self.requests.append(url)
+                return MockResponse({'error': {'code': 400, 'message': 'm',
+                    'errors': [{'reason': 'invalidParameter'}]}})
+
+        session = Invalid(days=1)
+        queue = self.queue(retry_delay=0)
+        queue.enqueue('visits', ['1'], '2012-01-01', '2012-01-01', ['visits'])
+
+        # A task that cannot be built is not retried either.
+        queue.add('broken', '1', '2012-01-02', '2012-01-02',
+            {'metrics': ['visits'], 'sort': 'visits'})
+
+        eq_(0, gc.run_worker(queue, session, lambda task, rows: None))
+        eq_(1, len(session.requests))
+        eq_({'failed': 2}, queue.counts())
+
+
+    def test_failing_task (self):
+        queue = self.queue(max_attempts=2, retry_delay=0)
+        queue.enqueue('visits', ['1'], '2012-01-01', '2012-01-01', ['visits'])
+
+        def sink (task, rows):
+            raise IOError('disk full')
 
+        eq_(0, gc.run_worker(queue, FakeAnalytics(days=1), sink))
+        eq_({'failed': 1}, queue.counts())